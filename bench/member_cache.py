@@ -0,0 +1,183 @@
+"""
+  Cold-start cost and resident memory of Biggs' member cache policies (see
+  `member_cache` in settings.example.yml), against synthetic guilds.
+
+  Each policy and guild size runs in its own process, so RSS figures don't
+  bleed into each other. A run replays what the gateway sends: the
+  GUILD_CREATE, the member chunks (for "full"), then `--messages` messages
+  from `--authors` distinct members, then `--lookups` membership checks as
+  ,anon makes them from DMs, with REST fetches stubbed out and counted.
+  Startup time covers our side of chunking only; on a real connection
+  each chunk (1000 members) is also a gateway round trip. Runs offline.
+
+  Usage (from the repository root):
+    python3 -m bench.member_cache [--sizes N ...] [--policies P ...] [--json PATH]
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from discord import ClientUser, Intents, Member
+from discord.state import ConnectionState
+from discord.guild import Guild
+
+from lib.utils.members import GuildMembers, member_cache_options
+
+GUILD_ID = 1
+BOT_ID = 2
+CHUNK_SIZE = 1000
+ROLES = [str(10 + i) for i in range(20)]
+
+def rss_kib() -> int:
+  """ Current resident set size, or the peak where /proc isn't around. """
+  try:
+    with open("/proc/self/status") as f:
+      for line in f:
+        if line.startswith("VmRSS:"): return int(line.split()[1])
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def member_data(user_id: int) -> dict:
+  return {
+    "user": { "id": str(user_id), "username": f"user{user_id}", "discriminator": f"{user_id % 10000:04}", "avatar": None },
+    "roles": random.sample(ROLES, 3),
+    "nick": None,
+    "joined_at": "2020-01-01T00:00:00+00:00",
+    "deaf": False,
+    "mute": False,
+  }
+
+class BenchMessage:
+  def __init__(self, guild: Guild, author: Member):
+    self.guild = guild
+    self.author = author
+
+class BenchGuild:
+  """ The real guild, with fetch_member stubbed out. """
+  def __init__(self, guild: Guild, state: ConnectionState):
+    self._guild = guild
+    self._state = state
+    self.id = guild.id
+
+  @property
+  def chunked(self) -> bool:
+    return self._guild.chunked
+
+  def get_member(self, user_id: int):
+    return self._guild.get_member(user_id)
+
+  async def fetch_member(self, user_id: int) -> Member:
+    return Member(data=member_data(user_id), guild=self._guild, state=self._state)
+
+def child(policy: str, size: int, messages: int, authors: int, lookups: int) -> dict:
+  """ One run, in this process. """
+  random.seed(0)
+  loop = asyncio.new_event_loop()
+  intents = Intents.default()
+  intents.members = True
+  state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, syncer=None, http=None, loop=loop,
+    intents=intents, **member_cache_options(policy))
+  state.user = ClientUser(state=state, data={ "id": str(BOT_ID), "username": "Biggs", "discriminator": "0001", "avatar": None, "bot": True })
+  gc.collect()
+  baseline = rss_kib()
+
+  # Startup: the GUILD_CREATE for a large guild only carries the bot itself,
+  # the rest arrive in chunks if the policy asks for them
+  start = time.perf_counter()
+  guild = Guild(data={
+    "id": str(GUILD_ID), "name": "bench", "member_count": size, "large": True,
+    "roles": [{ "id": role, "name": role, "permissions": "0" } for role in ROLES],
+    "members": [member_data(BOT_ID)],
+  }, state=state)
+  chunks = 0
+  if state._guild_needs_chunking(guild):
+    for offset in range(0, size, CHUNK_SIZE):
+      chunk = [member_data(100 + i) for i in range(offset, min(offset + CHUNK_SIZE, size))]
+      # As ChunkRequest.add_members does
+      for member in [Member(guild=guild, data=data, state=state) for data in chunk]:
+        guild._add_member(member)
+      chunks += 1
+  startup = time.perf_counter() - start
+  gc.collect()
+  after_startup = rss_kib()
+
+  # Traffic: authors come with every message, cached or not
+  members = GuildMembers(BenchGuild(guild, state), logging.getLogger("bench"), maxsize=CHUNK_SIZE)
+  speakers = random.sample(range(100, 100 + size), min(authors, size))
+  for _ in range(messages):
+    author = Member(data=member_data(random.choice(speakers)), guild=guild, state=state)
+    if policy != "full": members.saw_message(BenchMessage(guild, author))
+  gc.collect()
+  after_traffic = rss_kib()
+
+  # DM checks, half of them from people who've spoken lately
+  start = time.perf_counter()
+  for i in range(lookups):
+    user_id = random.choice(speakers) if i % 2 else random.randrange(100, 100 + size)
+    loop.run_until_complete(members.is_member(user_id))
+  lookup = time.perf_counter() - start
+  loop.close()
+
+  return {
+    "startup_ms": round(startup * 1000, 2),
+    "chunks": chunks,
+    "cached_members": len(guild._members),
+    "rss_startup_mib": round((after_startup - baseline) / 1024, 2),
+    "rss_traffic_mib": round((after_traffic - baseline) / 1024, 2),
+    "lookup_ms": round(lookup * 1000, 2),
+    "rest_fetches": members.rest,
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 200000], help="guild member counts")
+  parser.add_argument("--policies", nargs="+", default=["full", "recent"], choices=["full", "recent"])
+  parser.add_argument("--messages", type=int, default=10000)
+  parser.add_argument("--authors", type=int, default=2000, help="distinct members sending those messages")
+  parser.add_argument("--lookups", type=int, default=1000, help="membership checks made from DMs")
+  parser.add_argument("--json", default="./data/bench_member_cache.json", help="where to write the results")
+  parser.add_argument("--child", nargs=2, metavar=("POLICY", "SIZE"), help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    policy, size = args.child
+    print(json.dumps(child(policy, int(size), args.messages, args.authors, args.lookups)))
+    return
+
+  results = {}
+  for policy in args.policies:
+    for size in args.sizes:
+      print(f"Running {policy} @ {size} members...", file=sys.stderr)
+      out = subprocess.check_output([sys.executable, "-m", "bench.member_cache", "--child", policy, str(size),
+        "--messages", str(args.messages), "--authors", str(args.authors), "--lookups", str(args.lookups)])
+      results.setdefault(policy, {})[size] = json.loads(out)
+
+  for policy, by_size in results.items():
+    print(f"\n{policy}")
+    print(f"{'measure':<18}" + "".join(f"{size:>12}" for size in by_size))
+    for measure in next(iter(by_size.values())):
+      print(f"{measure:<18}" + "".join(f"{by_size[size][measure]:>12}" for size in by_size))
+
+  os.makedirs(os.path.dirname(args.json) or ".", exist_ok=True)
+  with open(args.json, "w") as f:
+    json.dump({
+      "time": int(time.time()),
+      "messages": args.messages,
+      "authors": args.authors,
+      "lookups": args.lookups,
+      "results": results,
+    }, f, indent=2)
+  print(f"\nWrote {args.json}")
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+  Benchmarks Biggs' persistence paths against synthetic tables.
+
+  Generates `roles`, `reminders` and `schedule` tables of each size (rows
+  follow the schemas in lib/schema/), then times startup and the hot cog
+  methods, called with stubbed contexts. Runs offline.
+
+  Usage (from the repository root):
+    python3 -m bench.persistence [--sizes N ...] [--engines E ...] [--repeat N] [--json PATH]
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# The services' task loops bind to the current event loop on import
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+
+import jsonschema
+
+from lib.utils.sqlitedb import SQLiteDB, open_db
+from lib.utils.storage import Storage
+from lib.services.role import Role
+from lib.services.reminder import Reminder
+from lib.services.schedule import Schedule
+
+CHANNELS = 50
+# Reminders already due when tick runs
+DUE = 10
+
+# Stubs
+class BenchChannel:
+  def __init__(self, _id: int):
+    self.id = _id
+
+  async def send(self, *args, **kwargs):
+    pass
+
+class BenchRole:
+  def __init__(self, _id: int):
+    self.id = _id
+    self.mention = f"<@&{_id}>"
+
+class BenchGuild:
+  id = 1
+
+  def get_channel(self, _id: int) -> BenchChannel:
+    return BenchChannel(_id)
+
+  def get_role(self, _id: int) -> BenchRole:
+    return BenchRole(_id)
+
+class BenchBot:
+  def __init__(self, db):
+    self._db = db
+    self._storage = Storage(db)
+    self._config = {}
+    self._guild = BenchGuild()
+    self._notice_channel = BenchChannel(0)
+    self._reactions = {}
+    self.command_prefix = ","
+
+  def add_listener(self, func, name: str = None):
+    pass
+
+  async def wait_until_ready(self):
+    pass
+
+class BenchMember:
+  def __init__(self, _id: int):
+    self.id = _id
+    self.bot = False
+    self.roles = []
+
+  async def add_roles(self, *roles):
+    pass
+
+  async def remove_roles(self, *roles):
+    pass
+
+class BenchMessage:
+  def __init__(self, author: BenchMember, channel: BenchChannel):
+    self.id = random.getrandbits(62)
+    self.author = author
+    self.channel = channel
+    self.created_at = datetime.datetime.utcnow()
+
+  async def add_reaction(self, *args):
+    pass
+
+class BenchContext:
+  def __init__(self, bot: BenchBot, member_id: int):
+    self.bot = bot
+    self.author = BenchMember(member_id)
+    self.channel = BenchChannel(random.randrange(CHANNELS))
+    self.message = BenchMessage(self.author, self.channel)
+    self.guild = bot._guild
+
+  async def reply(self, *args, **kwargs):
+    pass
+
+  async def send(self, *args, **kwargs):
+    pass
+
+# Synthetic data
+def synthetic(size: int) -> dict:
+  """ TinyDB-shaped tables of `size` rows each. """
+  now = int(time.time())
+  members = max(size // 10, 1)
+  roles = { str(i + 1): { "id": 10 ** 17 + i } for i in range(size) }
+  reminders = {
+    str(i + 1): {
+      "datetime": now - 60 if i < DUE else now + random.randrange(60, 365 * 86400),
+      "channel":  random.randrange(CHANNELS),
+      "message":  f"Synthetic reminder {i}",
+      "meta": {
+        "message":  random.getrandbits(62),
+        "member":   random.randrange(members),
+        "datetime": now - random.randrange(86400),
+      },
+    }
+    for i in range(size)
+  }
+  schedule = {
+    str(i + 1): {
+      "type":      "message",
+      "channel":   random.randrange(CHANNELS),
+      "message":   f"Synthetic task {i}",
+      "when":      { "every": random.randrange(1, 24), "unit": "hours" },
+    }
+    for i in range(size)
+  }
+
+  # Spot-check against the real schemas
+  for rows, name in ((reminders, "reminder"), (schedule, "schedule_task")):
+    with open(f"./lib/schema/{name}.json") as f:
+      schema = json.load(f)
+    for row in list(rows.values())[:100]:
+      jsonschema.validate(instance=row, schema=schema)
+
+  return { "roles": roles, "reminders": reminders, "schedule": schedule }
+
+def write_db(engine: str, path: str, data: dict):
+  with open(f"{path}.json", "w") as f:
+    json.dump(data, f)
+  if engine == "sqlite":
+    db = SQLiteDB(f"{path}.sqlite3")
+    db.import_json(f"{path}.json")
+    db.close()
+
+# Measurements
+def timed(coro_fn, repeat: int) -> float:
+  """ Median milliseconds of `repeat` runs of `coro_fn()`. """
+  samples = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    loop.run_until_complete(coro_fn())
+    samples.append((time.perf_counter() - start) * 1000)
+  return statistics.median(samples)
+
+def bench(engine: str, size: int, repeat: int, workdir: str) -> dict:
+  path = os.path.join(workdir, f"biggs-{engine}-{size}")
+  write_db(engine, path, synthetic(size))
+  results = {}
+
+  async def startup():
+    db = open_db(engine, path)
+    bot = BenchBot(db)
+    cogs = [Role(bot), Reminder(bot), Schedule(bot)]
+    for cog in cogs: cog.cog_unload()
+    bot._storage.close()
+  results["startup load"] = timed(startup, repeat)
+
+  async def setup():
+    bot = BenchBot(open_db(engine, path))
+    return bot, Role(bot), Reminder(bot)
+  bot, role, reminder = loop.run_until_complete(setup())
+  # Drive tick by hand
+  reminder.tick.cancel()
+  member = reminder._reminders.all()[-1]["meta"]["member"]
+
+  async def tick():
+    await Reminder.tick.coro(reminder)
+  results["Reminder.tick"] = timed(tick, 1)
+
+  async def rem_list():
+    await Reminder.list.callback(reminder, BenchContext(bot, member))
+  results["Reminder.list"] = timed(rem_list, repeat)
+
+  inserted = []
+  async def rem_insert():
+    ctx = BenchContext(bot, member)
+    await Reminder.reminder.callback(reminder, ctx, reminder="in 2 hours: Benchmark")
+    inserted.append(max(reminder._reminders.ids("member", member)))
+  results["reminder insert"] = timed(rem_insert, repeat)
+
+  async def flush():
+    await bot._storage.flush()
+  results["flush after insert"] = timed(flush, 1)
+
+  async def rem_remove():
+    await Reminder.remove.callback(reminder, BenchContext(bot, member), inserted.pop())
+  results["reminder remove"] = timed(rem_remove, repeat)
+  results["flush after remove"] = timed(flush, 1)
+
+  target = BenchRole(10 ** 17 + size // 2)
+  async def role_add():
+    await Role.add.callback(role, BenchContext(bot, member), role=target)
+  results["Role.add lookup"] = timed(role_add, repeat)
+
+  role.cog_unload()
+  reminder.cog_unload()
+  bot._storage.close()
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+  parser.add_argument("--engines", nargs="+", default=["tinydb", "sqlite"], choices=["tinydb", "sqlite"])
+  parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the median is reported")
+  parser.add_argument("--json", default="./data/bench_persistence.json", help="where to write the results")
+  args = parser.parse_args()
+
+  logging.disable(logging.INFO)
+  random.seed(0)
+
+  results = {}
+  with tempfile.TemporaryDirectory() as workdir:
+    for engine in args.engines:
+      for size in args.sizes:
+        print(f"Running {engine} @ {size} rows...", file=sys.stderr)
+        results.setdefault(engine, {})[size] = bench(engine, size, args.repeat, workdir)
+
+  # Table, in milliseconds
+  for engine, by_size in results.items():
+    print(f"\n{engine} (median ms)")
+    print(f"{'operation':<22}" + "".join(f"{size:>12}" for size in by_size))
+    for op in next(iter(by_size.values())):
+      print(f"{op:<22}" + "".join(f"{by_size[size][op]:>12.2f}" for size in by_size))
+
+  os.makedirs(os.path.dirname(args.json) or ".", exist_ok=True)
+  with open(args.json, "w") as f:
+    json.dump({
+      "time": int(time.time()),
+      "repeat": args.repeat,
+      "unit": "ms",
+      "results": results,
+    }, f, indent=2)
+  print(f"\nWrote {args.json}")
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,65 @@
+"""
+  Per-parse latency of the reminder time parser, for both the fast path and
+  the dateparser fallback.
+
+  Usage (from the repository root):
+    python3 -m bench.reminder_parse [--number N]
+"""
+
+import argparse
+import sys
+import time
+import timeit
+
+from lib.services.reminder import parse_when, parse_when_fast, normalize_when, _parse_when_slow
+
+FAST = [
+  "in 2 hours",
+  "in 3d 4h",
+  "1 hour and 30 minutes",
+  "tomorrow 14:00",
+  "next friday",
+  "2030-06-01 09:30",
+]
+SLOW = [
+  "in 2 months",
+  "next week",
+  "June 3rd at 5pm",
+]
+
+def per_call(fn, number: int) -> float:
+  """ Mean seconds per call of `fn`. """
+  return timeit.timeit(fn, number=number) / number
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--number", type=int, default=1000, help="calls per measurement (fast path)")
+  args = parser.parse_args()
+
+  now = int(time.time())
+  languages = ("en",)
+
+  _start = time.perf_counter()
+  _parse_when_slow(normalize_when(SLOW[0]), now // 60, languages)
+  first = time.perf_counter() - _start
+  print(f"dateparser first call (import + language data): {first * 1000:10.1f} ms")
+  print()
+
+  print(f"{'expression':<28} {'path':<8} {'uncached':>12} {'cached':>12}")
+  for text in FAST:
+    assert parse_when_fast(normalize_when(text), now) is not None, text
+    fast = per_call(lambda: parse_when(text, now, languages), args.number)
+    print(f"{text:<28} {'fast':<8} {fast * 1e6:9.1f} us {'-':>12}")
+
+  slow_number = max(args.number // 50, 5)
+  for text in SLOW:
+    assert parse_when_fast(normalize_when(text), now) is None, text
+    def uncached():
+      _parse_when_slow.cache_clear()
+      parse_when(text, now, languages)
+    slow = per_call(uncached, slow_number)
+    cached = per_call(lambda: parse_when(text, now, languages), args.number)
+    print(f"{text:<28} {'fallback':<8} {slow * 1e6:9.1f} us {cached * 1e6:9.1f} us")
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,33 +1,48 @@
+import os
+
 # External dependencies
-from tinydb import TinyDB
 from discord import Intents
 from discord.ext.commands import Context
 
 # Local dependencies
 from lib.proto import Proto
 from lib.utils.checks import is_bot_ready, is_not_ignored_channel, is_not_from_bot
-# Services
-from lib.services.core import Core
-from lib.services.role import Role
-from lib.services.time import Time
-from lib.services.anon import Anon
-from lib.services.schedule import Schedule
-from lib.services.reminder import Reminder
-from lib.services.fun import Fun
+from lib.utils.members import GuildMembers, member_cache_options, MEMBER_CACHE_SIZE, MEMBER_CACHE_TTL
+from lib.utils.sqlitedb import SQLiteDB, open_db
+from lib.utils.storage import Storage
 
 class Biggs(Proto):
   def __init__(self, config: dict):
     # Intents
     # https://discordpy.readthedocs.io/en/stable/intents.html
     intents = Intents.default()
-    # Need members intent for lib.utils.checks.is_guild_member
+    # Need members intent for lib.utils.checks.is_guild_member, and for the
+    # joins and leaves that keep lib.utils.members up to date
     intents.members = True
-    super().__init__(config, intents=intents)
+    self._member_cache = config.get("member_cache", "full")
+    super().__init__(config, intents=intents, **member_cache_options(self._member_cache))
 
   async def _do_setup(self):
     # Internal props
-    self._db = TinyDB(f"./data/biggs.json")
+    self._db = open_db(self._config.get("storage", "tinydb"), "./data/biggs")
+    # One-shot import of the JSON database into a new SQLite one
+    if isinstance(self._db, SQLiteDB) and self._db.is_empty() and os.path.exists("./data/biggs.json"):
+      imported = self._db.import_json("./data/biggs.json")
+      self.log.info(f"Imported ./data/biggs.json into SQLite: {imported}")
+    self._storage = Storage(self._db,
+      interval = self._config.get("storage_flush_interval", 1),
+      batch    = self._config.get("storage_flush_batch", 100))
     self._guild = self.get_guild(self._config["guild_id"])
+    self._members = GuildMembers(self._guild, self.log.getChild("Members"),
+      ttl=self._config.get("member_cache_ttl", MEMBER_CACHE_TTL),
+      maxsize=self._config.get("member_cache_size", MEMBER_CACHE_SIZE))
+    self.add_listener(self._members.member_joined, "on_member_join")
+    if self._member_cache == "recent":
+      self.register_message_handler(self._members.saw_message)
+      # on_member_remove needs the member cached, see lib/utils/members.py
+      self.add_listener(self._members.socket_response, "on_socket_response")
+    else:
+      self.add_listener(self._members.member_left, "on_member_remove")
     self._notice_channel = self.get_channel(self._config["notice_channel_id"])
     self._ignored_channels = [self.get_channel(c) for c in self._config["ignored_channels"]]
 
@@ -39,13 +54,18 @@ class Biggs(Proto):
     self._reactions = { key: parse_reactions(_id) for key, _id in self._config["reactions"].items() }
 
     # Services
-    self.add_cog(Core(self))
-    self.add_cog(Role(self))
-    self.add_cog(Time(self))
-    self.add_cog(Anon(self))
-    self.add_cog(Schedule(self))
-    # self.add_cog(Reminder(self))
-    self.add_cog(Fun(self))
+    self.load_service("lib.services.core.Core")
+    self.load_service("lib.services.role.Role")
+    self.load_service("lib.services.time.Time")
+    self.load_service("lib.services.anon.Anon")
+    self.load_service("lib.services.schedule.Schedule")
+    self.load_service("lib.services.reminder.Reminder")
+    self.load_service("lib.services.fun.Fun")
+
+  async def close(self):
+    await super().close()
+    # Final flush, after the cogs are unloaded
+    if self._done_setup: self._storage.close()
 
   def funnel(self, ctx: Context) -> bool:
     return (
@@ -1,44 +1,100 @@
-from subprocess import check_output
+import importlib
 import logging
+from typing import Optional
 
-from discord.ext.commands import Bot, Context
-from discord import Intents
+from discord.ext.commands import AutoShardedBot, Context
+from discord import Intents, Message
 
-from lib.utils.text import fmt_guild
+from lib.utils.text import fmt_guild, fmt_plur
+from lib.utils.dispatch import MessageDispatcher, MessageHandler
+from lib.utils.outbox import Outbox
+from lib.utils.startup import profile
+from lib.utils.version import git_commit
 
-class Proto(Bot):
+class Proto(AutoShardedBot):
   """
     Superclass for bots.
     Please define a `do_setup` method.
+
+    Runs the shards in `shard_ids` out of `shard_count`, or every shard
+    Discord recommends if those aren't configured.
   """
-  def __init__(self, config: dict, *, intents: Intents = Intents.default()):
-    super().__init__(command_prefix=config["command_prefix"], intents=intents)
+  def __init__(self, config: dict, *, intents: Intents = Intents.default(), **options):
+    super().__init__(command_prefix=config["command_prefix"], intents=intents,
+      shard_count=config.get("shard_count"),
+      shard_ids=config.get("shard_ids"),
+      **options)
 
     self.log = logging.getLogger(self.__class__.__name__)
 
-    self.version = check_output(
-      "git rev-parse --short HEAD".split(" ")
-    ).decode("utf-8").strip()
+    self.version = git_commit()[0]
 
     self._config = config
+    # Set when this is one of several processes, see `mycelia.py run --shards`
+    self.cluster = config.get("cluster") # type: Optional[int]
     self._done_setup = False
+    self._messages = MessageDispatcher(self.log)
+    self._outbox = Outbox(logging.getLogger(f"{self.__class__.__name__}.Outbox"))
 
     self.run(config["token"])
 
+  async def login(self, *args, **kwargs):
+    with profile.phase("login"):
+      await super().login(*args, **kwargs)
+
   async def on_ready(self):
     if not self._done_setup:
+      profile.mark("gateway ready")
       try: await self._do_setup()
       except Exception as exc:
         self.log.error(exc)
         exit()
       self._done_setup = True
+      profile.mark("setup done")
+      if profile.enabled: print(profile.report(), flush=True)
     # Done loading
     self.log.info("Initial setup done.")
 
+    shards = self.shard_ids or range(self.shard_count)
+    self.log.info(f"Running shard{fmt_plur(len(shards))} {', '.join(map(str, shards))} of {self.shard_count}.")
     self.log.info(f"Logged in as {self.user}, a member of these guilds:")
     for guild in self.guilds:
       self.log.info(f"• {fmt_guild(guild)}")
 
+  @property
+  def outbox(self) -> Outbox:
+    """ Where services send messages from, see <lib.utils.outbox.Outbox>. """
+    return self._outbox
+
+  def load_service(self, path: str):
+    """
+      Imports and adds a service cog by path, ie "lib.services.core.Core",
+      so its module (and dependencies) only load for the bots using it.
+    """
+    module, name = path.rsplit(".", 1)
+    with profile.phase(f"service {name}"):
+      self.add_cog(getattr(importlib.import_module(module), name)(self))
+
+  def register_message_handler(self, func, **filters) -> MessageHandler:
+    """
+      Runs `func` on messages that pass every filter given, see
+      <lib.utils.dispatch.MessageHandler>. Prefer this over on_message
+      listeners, which are scheduled for every single message.
+    """
+    return self._messages.register(func, **filters)
+
+  def unregister_message_handler(self, handler: MessageHandler):
+    """ Stops running a handler from `register_message_handler`, ie. when its service unloads. """
+    self._messages.unregister(handler)
+
+  def message_handler_stats(self) -> dict:
+    """ Messages seen and matched per handler, with errors and time spent. """
+    return self._messages.stats()
+
+  async def on_message(self, message: Message):
+    self._messages.dispatch(message)
+    await self.process_commands(message)
+
   def funnel(self, ctx: Context) -> bool:
     """
       "Command funnel" - Override this with any number of checks that must
@@ -1,7 +1,8 @@
 from discord.ext import commands
 
 from lib.utils.etc import Service, react
-from lib.utils.checks import in_dms, is_guild_member
+from lib.utils.checks import in_dms, in_guild, is_guild_member, is_mod
+from lib.utils.text import fmt_list
 
 class Anon(Service):
   @commands.command()
@@ -16,3 +17,17 @@ class Anon(Service):
     else:
       await react(ctx, "confused")
       await ctx.reply("This command is available only in DMs.", delete_after=10, mention_author=False)
+
+  @commands.command(aliases=["ms"])
+  @commands.check(in_guild)
+  @commands.check(is_mod)
+  async def memberstats(self, ctx: commands.Context):
+    """ (Restricted to moderators) How ,anon's membership checks have been answered. See lib/utils/members.py. """
+    stats = ctx.bot._members.stats()
+    checks = stats["gateway"] + stats["cached"] + stats["rest"]
+    await ctx.reply(
+      f"**Membership checks** `{checks}`\n" + fmt_list([
+        f"`{stats['gateway']}` from the gateway cache (`{ctx.bot._config.get('member_cache', 'full')}` policy)",
+        f"`{stats['cached']}` from recent members, `{stats['size']}/{stats['maxsize']}` kept, `{stats['evictions']}` evicted",
+        f"`{stats['rest']}` fetched",
+      ]), mention_author=False)
@@ -1,16 +1,17 @@
-import subprocess
+from datetime import datetime
 
 from discord import Guild, Message
 from discord.ext import commands
 
-from lib.utils.etc import Service
+from lib.utils.etc import Service, readable_delta
 from lib.utils.text import fmt_guild
+from lib.utils.version import git_commit
 
 class Core(Service):
   def __init__(self, bot: commands.Bot):
     super().__init__(bot)
 
-    self.bot.add_listener(self.log_message, "on_message")
+    self.bot.register_message_handler(self.log_message)
     self.bot.add_listener(self.log_command_error, "on_command_error")
     self.bot.add_listener(self.log_guild_join, "on_guild_join")
     self.bot.add_listener(self.log_guild_remove, "on_guild_remove")
@@ -19,9 +20,8 @@ class Core(Service):
   @commands.command(name="version", aliases=["v", "hello"])
   async def version_command(self, ctx: commands.Context):
     """ Display current bot version. """
-    _date = subprocess.check_output(
-      "git log -1 --date=relative --format=%ad".split(" ")
-    ).decode("utf-8").strip()
+    _, timestamp = git_commit()
+    _date = readable_delta(datetime.now() - datetime.fromtimestamp(timestamp)) if timestamp else "at some point"
     await ctx.send(
       f"Mycelia (commit `{ctx.bot.version}`) — Last updated {_date}\n" \
       f":minidisc: <https://github.com/technoabyss/mycelia>"
@@ -38,8 +38,8 @@ class Core(Service):
     if before.name != after.name:
       self.log.info(f"The guild {before.name} has been renamed to {after.name}.")
 
-  # Log messages
-  async def log_message(self, message: Message):
+  # Log messages, inline (see lib/utils/dispatch.py)
+  def log_message(self, message: Message):
     self.log.msg(f"{message.guild.id}@{message.channel.id}§{message.author}: {message.content}")
 
   # Log errors
@@ -1,29 +1,73 @@
 import wavelink
 import re
-import subprocess
-import yaml
+import io
 import os
-from typing import Union, List
-from uuid import uuid4
-from itertools import islice
-from asyncio import Event, Queue, sleep
-from math import ceil
-from shlex import split
+import json
+import statistics
+import time
+import threading
+from typing import Dict, Optional, Union, List
+from asyncio import Event, sleep
 from collections import deque
-
-# import datetime
-# import humanize
+from math import ceil
 
 import discord
 from discord.utils import escape_markdown
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 from lib.utils.etc import Service, time_hms
-from lib.utils.checks import in_dms
+from lib.utils.checks import in_dms, is_operator
 from lib.utils.text import fmt_list, fmt_plur
+from lib.utils.playlist import Playlist
+from lib.utils.cache import TTLCache
+from lib.utils.lavalink import LavalinkProcess, LavalinkRemote
+from lib.utils.telemetry import Telemetry
 
-LAVALINK_READY = re.compile(" lavalink.server.Launcher\s+: Started Launcher")
 RURL = re.compile("https?:\/\/.+") # barebones but good enough
+# YouTube playlist links, and the video they point into
+RPLAYLIST = re.compile(r"[?&]list=[\w-]+")
+RVIDEO = re.compile(r"[?&]v=([\w-]{11})")
+
+# Lavalink lookups, shared between guilds
+TRACK_CACHE_SIZE = 2048
+TRACK_CACHE_TTL = 6 * 3600
+# Live streams go stale (or end) much sooner
+STREAM_CACHE_TTL = 5 * 60
+
+# Seconds before the current track ends to re-check the next one
+PREFETCH_AHEAD = 15
+# Track transitions kept for ,gaps
+GAP_SAMPLES = 500
+
+# Queues are saved here every QUEUE_SAVE_INTERVAL seconds, and on unload
+QUEUES_PATH = "./data/smalls_queues.json"
+QUEUE_SAVE_INTERVAL = 60
+
+# Controllers with nothing playing, or an empty voice channel, are torn
+# down after this many seconds; at most this many exist at once
+IDLE_TIMEOUT = 300
+MAX_CONTROLLERS = 1000
+# Pending ,play search results, per user
+SEARCH_TTL = 120
+MAX_SEARCHES = 1000
+
+# Seconds between checks for degraded nodes
+REBALANCE_INTERVAL = 30
+# Load past which a node is degraded; around 70% CPU, or a steady frame
+# deficit (see wavelink.stats.Penalty)
+DEGRADED_LOAD = 300
+
+# Node and player stats are sampled every TELEMETRY_INTERVAL seconds, and
+# the lot written here for anything that wants to graph it
+TELEMETRY_INTERVAL = 30
+TELEMETRY_PATH = "./data/smalls_telemetry.json"
+
+def track_key(query: str) -> str:
+  """ Normalizes a search query or URL for the track cache. """
+  query = query.strip()
+  # Video ids are case-sensitive, fragments never reach Lavalink anyway
+  if RURL.match(query): return query.split("#")[0]
+  return " ".join(query.lower().split())
 
 def fmt_tracklist(tracks: List[wavelink.Track], page = 1) -> str:
   lst = []
@@ -38,30 +82,72 @@ def fmt_tracklist(tracks: List[wavelink.Track], page = 1) -> str:
     lst.append(_out)
   return fmt_list(lst)
 
+def track_length(track: wavelink.Track) -> int:
+  """ Milliseconds the track adds to the queue, streams don't count. """
+  return 0 if track.is_stream else track.length
+
+def cluster_path(path: str, cluster: Optional[int]) -> str:
+  """ `path` for one cluster of a sharded bot, ie ./data/smalls_queues.2.json. """
+  if cluster is None: return path
+  root, ext = os.path.splitext(path)
+  return f"{root}.{cluster}{ext}"
+
+def write_json(path: str, state: dict):
+  """ Writes a JSON file atomically, so a crash mid-write can't lose it. """
+  with open(f"{path}.tmp", "w") as f:
+    json.dump(state, f)
+  os.replace(f"{path}.tmp", path)
+
+def fmt_mib(size: int) -> str:
+  return f"{size / 2**20:.0f}MiB"
+
+def node_load(node: wavelink.Node) -> float:
+  """
+    Lavalink's load penalty for a node, counting players we've placed
+    since its last stats. The stats also count other clusters' players, so
+    our own count only ever adds to them.
+  """
+  if not node.is_available: return float("inf")
+  if node.stats is None:    return len(node.players)
+  return node.stats.penalty.total + max(0, len(node.players) - node.stats.playing_players)
+
 class MusicController:
-  def __init__(self, bot, guild_id):
-    self.bot = bot
+  def __init__(self, music: "Music", guild_id):
+    self.music = music
+    self.bot = music.bot
     self.guild_id = guild_id
     self.channel = None
 
     self.next = Event()
-    self.queue = Queue()
+    self.queue = Playlist(track_length) # type: Playlist[wavelink.Track]
 
     self.volume = 40
+    # Where to start the next track, for restored queues
+    self.start_at = 0
+    # When the last track finished with another queued, see track_started
+    self.ended_at = None # type: Optional[float]
+    # For reaping, see Music.reap_controllers
+    self.last_active = time.monotonic()
+    self.empty_since = None # type: Optional[float]
+
+    self.task = self.bot.loop.create_task(self.controller_loop())
 
-    self.bot.loop.create_task(self.controller_loop())
+  def destroy(self):
+    """ Stops the controller loop. """
+    self.task.cancel()
 
   async def controller_loop(self):
     await self.bot.wait_until_ready()
 
-    player = self.bot._wavelink.get_player(self.guild_id)
+    player = self.music.get_player(self.guild_id)
     await player.set_volume(self.volume)
 
     while True:
       self.next.clear()
 
       track = await self.queue.get() # type: wavelink.player.Track
-      await player.play(track)
+      await player.play(track, start=self.start_at)
+      self.start_at = 0
 
       _out = ""
       _out += f":arrow_forward: "
@@ -70,71 +156,360 @@ class MusicController:
       else:
         _out += f"`[STREAM]`"
       _out += f" {escape_markdown(track.title)}"
-      await self.channel.send(_out)
-
-      await self.next.wait()
+      await self.bot.outbox.sticky(("now playing", self.guild_id), self.channel, _out)
+
+      prefetch = self.bot.loop.create_task(self.prefetch(player))
+      try:     await self.next.wait()
+      finally: prefetch.cancel()
+
+  async def prefetch(self, player: wavelink.Player):
+    """
+      Re-resolves queued streams shortly before the current track ends, so
+      the handover doesn't stall on one that has gone offline. Lavalink
+      resolves sources itself when a track starts, regular tracks are
+      already good to go.
+    """
+    if (current := player.current) is not None and not current.is_stream:
+      await sleep(max(0, (current.length - player.position) / 1000 - PREFETCH_AHEAD))
+
+    while self.queue and (track := self.queue[0]).is_stream:
+      fresh = await self.music.get_tracks(track.uri, refresh=True)
+      # Skipped or reordered meanwhile
+      if not self.queue or self.queue[0] is not track: continue
+      self.queue.pop(0)
+      if fresh:
+        self.queue.insert(0, fresh[0])
+        return
+      self.music.log.info(f"Dropped offline stream {track.uri} from the queue of guild {self.guild_id}.")
+
+  def track_ended(self):
+    if self.queue: self.ended_at = time.perf_counter()
+    self.next.set()
+
+  def track_started(self):
+    self.last_active = time.monotonic()
+    if self.ended_at is not None:
+      self.music.record_gap(time.perf_counter() - self.ended_at)
+      self.ended_at = None
 
 class Music(Service):
   def __init__(self, bot):
     super().__init__(bot)
     self.controllers = {}
     self.bot._wavelink = wavelink.Client(bot=self.bot)
-    _path = self.bot._config["lavalink_path"]
-    _args = self.bot._config["lavalink_args"]
-    self._lavalink = subprocess.Popen(
-      split(f"java -jar ./Lavalink.jar {_args}"),
-      shell=False, cwd=_path,
-      stdout=subprocess.PIPE,
-      universal_newlines=True)
-    self._searchresults = {}
-
-    self.bot.add_listener(self.listen_searchresults, "on_message")
-
-    rc = 0
-    while True:
-      stdout = self._lavalink.stdout.readline()
-      if stdout == "" and rc is not None:
-        break
-      if LAVALINK_READY.search(stdout):
-        self.bot.loop.create_task(self.start_nodes())
-        break
-      rc = self._lavalink.poll()
-
-  # Guilds only
+    self._searchresults = TTLCache(MAX_SEARCHES, SEARCH_TTL)
+    # Clusters each keep their own, see mycelia.py
+    self._queues_path = cluster_path(QUEUES_PATH, self.bot.cluster)
+    self._telemetry_path = cluster_path(TELEMETRY_PATH, self.bot.cluster)
+    self._idle_timeout = self.bot._config.get("music_idle_timeout", IDLE_TIMEOUT)
+    self._max_controllers = self.bot._config.get("music_max_controllers", MAX_CONTROLLERS)
+    # Seconds between one track ending and the next starting
+    self._gaps = deque(maxlen=GAP_SAMPLES)
+    self._tracks = TTLCache(
+      self.bot._config.get("track_cache_size", TRACK_CACHE_SIZE),
+      self.bot._config.get("track_cache_ttl", TRACK_CACHE_TTL))
+    # Connected nodes by name; ready while there's at least one
+    self._nodes = {} # type: Dict[str, wavelink.Node]
+    self._ready = Event()
+    # Node stats, player counts and REST call timings, see sample_telemetry
+    self._telemetry = Telemetry()
+
+    # Picking a search result, ie "3" or ",p 3"
+    self._rpick = re.compile(fr"^({re.escape(self.bot.command_prefix)}(p(lay)?\s+)?)?(10|[1-9])$")
+    self._pick_handler = self.bot.register_message_handler(self.check_searchresults, authors=self._searchresults, pattern=self._rpick)
+
+    # Lavalink was started (and is supervised) by the bot, see lib/smalls.py
+    self._nodes_tasks = [
+      self.bot.loop.create_task(self.manage_node(name, lavalink))
+      for name, lavalink in self.bot._lavalink.items()
+    ]
+    self.rebalance.start()
+    self.reap_controllers.start()
+    self.sample_telemetry.start()
+    # Saving starts once the last run's queues are back
+    self._restored = False
+    # Saved guilds that couldn't be restored, kept in the file for next time
+    self._unrestored = {} # type: Dict[str, dict]
+    # Periodic saves run in a thread, the final one doesn't; the newest wins
+    self._save_lock = threading.Lock()
+    self._save_generation = 0
+    self._saved_generation = 0
+    self._restore_task = self.bot.loop.create_task(self.restore_queues())
+
+  # Guilds only, once Lavalink is up
   async def cog_check(self, ctx: commands.Context):
-    return not in_dms(ctx)
+    # Telemetry is most wanted when things are going wrong
+    if (ctx.command.root_parent or ctx.command) is self.telemetry: return True
+    if in_dms(ctx): return False
+    if not self._ready.is_set():
+      self.bot.outbox.notify(ctx.channel, "Music is still warming up, try again in a moment...")
+      return False
+    if (controller := self.controllers.get(ctx.guild.id)) is not None:
+      controller.last_active = time.monotonic()
+    elif not await self.make_room():
+      self.bot.outbox.notify(ctx.channel, "I'm playing in too many servers right now, try again later...")
+      return False
+    return True
 
-  # Close Lavalink when unloading
   def cog_unload(self):
-    self._lavalink.terminate()
-
-  async def start_nodes(self):
+    self.bot.unregister_message_handler(self._pick_handler)
+    self.rebalance.cancel()
+    self.reap_controllers.cancel()
+    self.sample_telemetry.cancel()
+    self.save_queues.cancel()
+    self._restore_task.cancel()
+    for task in self._nodes_tasks: task.cancel()
+    # Final save, Bot.close unloads cogs before disconnecting
+    if self._restored: self.store_queues(self.queue_state(), self.next_save_generation())
+    for controller in self.controllers.values(): controller.destroy()
+
+  async def manage_node(self, name: str, lavalink: Union[LavalinkProcess, LavalinkRemote]):
+    """ Connects a node whenever its Lavalink (re)starts, and drops it when it exits. """
     await self.bot.wait_until_ready()
 
-    _id = uuid4()
-
-    if not os.path.exists("./lavalink/application.yml"):
-      self.log.error("./lavalink/application.yml missing, exiting.")
-      exit()
-    with open("./lavalink/application.yml", "r") as y:
-      config = yaml.load(y, Loader=yaml.FullLoader) # type: dict
+    while True:
+      await lavalink.launched.wait()
+      try: node = await self.start_node(name, lavalink)
+      except Exception as exc:
+        self.log.error(f"Couldn't connect to Lavalink node {name}: {exc}")
+        await sleep(5)
+        continue
+      self._nodes[name] = node
+      self._ready.set()
+
+      await lavalink.exited.wait()
+      del self._nodes[name]
+      if not self._nodes: self._ready.clear()
+      self.log.warning(f"Lavalink node {name} went away, moving its players.")
+      node.close()
+      await self.evacuate(node)
+      try: await node.destroy()
+      except Exception as exc: self.log.error(f"Couldn't destroy node {name} cleanly: {exc}")
+
+  async def start_node(self, name: str, lavalink: Union[LavalinkProcess, LavalinkRemote]) -> wavelink.Node:
     node = await self.bot._wavelink.initiate_node(
-      identifier = str(_id),
-      region     = "eu_west",
-      host       = config["server"]["address"],
-      port       = config["server"]["port"],
-      rest_uri   = f"http://{config['server']['address']}:{config['server']['port']}",
-      password   = config["lavalink"]["server"]["password"]
+      identifier = name,
+      region     = lavalink.region,
+      host       = lavalink.host,
+      port       = lavalink.port,
+      rest_uri   = lavalink.rest_uri,
+      password   = lavalink.password
     )
-    self.log.info(f"Initiated Wavelink node with identifier {_id}.")
+    self.log.info(f"Initiated Wavelink node {name}.")
 
     # Set our node hook callback
     node.set_hook(self.on_event_hook)
+    return node
+
+  def best_node(self, exclude: Optional[wavelink.Node] = None) -> Optional[wavelink.Node]:
+    """ Least loaded available node. """
+    nodes = [n for n in self._nodes.values() if n.is_available and n is not exclude]
+    return min(nodes, key=node_load, default=None)
+
+  def get_player(self, guild_id: int) -> wavelink.Player:
+    """ The guild's player, placing new ones on the least loaded node. """
+    if (player := self.bot._wavelink.players.get(guild_id)) is not None: return player
+    node = self.best_node()
+    return self.bot._wavelink.get_player(guild_id, node_id=node.identifier if node else None)
+
+  async def move_player(self, player: wavelink.Player, node: wavelink.Node):
+    old = player.node.identifier
+    try:
+      await player.change_node(node.identifier)
+      self.log.info(f"Moved player for guild {player.guild_id} from node {old} to {node.identifier}.")
+    except Exception as exc:
+      self.log.error(f"Couldn't move player for guild {player.guild_id} off node {old}: {exc}")
+
+  async def evacuate(self, node: wavelink.Node):
+    """ Moves every player off `node`, spreading them over the others. """
+    for player in list(node.players.values()):
+      if (best := self.best_node(exclude=node)) is None:
+        return self.log.error(f"No nodes left to take players from node {node.identifier}.")
+      await self.move_player(player, best)
+
+  def queue_state(self) -> dict:
+    """ Every active guild's playback, with tracks as Lavalink track strings. """
+    state = dict(self._unrestored)
+    for gid, controller in self.controllers.items():
+      player = self.bot._wavelink.players.get(gid)
+      if player is None or not player.is_connected or controller.channel is None: continue
+      if player.current is None and not controller.queue: continue
+      state[str(gid)] = {
+        "voice_channel": player.channel_id,
+        "text_channel":  controller.channel.id,
+        "volume":        controller.volume,
+        "current":       player.current.id if player.current else None,
+        "position":      int(player.position),
+        "queue":         [track.id for track in controller.queue],
+      }
+    return state
+
+  @tasks.loop(seconds=QUEUE_SAVE_INTERVAL)
+  async def save_queues(self):
+    await self.bot.loop.run_in_executor(None, self.store_queues, self.queue_state(), self.next_save_generation())
+
+  def next_save_generation(self) -> int:
+    self._save_generation += 1
+    return self._save_generation
+
+  def store_queues(self, state: dict, generation: int):
+    """ Writes `state`, unless a newer one was written meanwhile. """
+    with self._save_lock:
+      if generation <= self._saved_generation: return
+      write_json(self._queues_path, state)
+      self._saved_generation = generation
+
+  async def decode_tracks(self, ids: List[str]) -> List[wavelink.Track]:
+    """ Lavalink track strings back into tracks, in one request. """
+    node = self.best_node()
+    with self._telemetry.timer("rest.decodetracks"):
+      async with self.bot._wavelink.session.post(f"{node.rest_uri}/decodetracks",
+        json=ids, headers={ "Authorization": node.password }) as resp:
+        resp.raise_for_status()
+        data = await resp.json()
+    return [wavelink.Track(id_=track["track"], info=track["info"]) for track in data]
+
+  async def restore_queues(self):
+    """ Picks up every guild's playback where the last run left off. """
+    await self._ready.wait()
+    try:
+      with open(self._queues_path, "r") as f:
+        state = json.load(f) # type: dict
+    except FileNotFoundError:
+      state = {}
+    except Exception as exc:
+      state = {}
+      # Moved aside rather than overwritten by the next save
+      os.replace(self._queues_path, f"{self._queues_path}.bad")
+      self.log.error(f"Couldn't read saved queues, moved them to {self._queues_path}.bad: {exc.__class__.__name__}: {exc}")
+
+    try:
+      # One decode for every guild
+      ids = [_id for saved in state.values() for _id in [saved["current"]] + saved["queue"] if _id]
+      decoded = await self.decode_tracks(ids) if ids else []
+      # Tracks are matched to guilds by position, so any missing would shift the rest
+      if len(decoded) != len(ids): raise ValueError(f"got {len(decoded)} tracks for {len(ids)} ids")
+      tracks = iter(decoded)
+    except Exception as exc:
+      # Keep the lot for next time
+      self._unrestored = state
+      self.log.error(f"Couldn't decode saved queues: {exc.__class__.__name__}: {exc}")
+      state = {}
+
+    for gid, saved in state.items():
+      queue = [next(tracks) for _id in [saved["current"]] + saved["queue"] if _id]
+      channel = self.bot.get_channel(saved["text_channel"])
+      if self.bot.get_guild(int(gid)) is None or channel is None: continue
+
+      try:
+        player = self.get_player(int(gid))
+        controller = self.get_controller(player)
+        controller.channel = channel
+        controller.volume = saved["volume"]
+        if saved["current"]: controller.start_at = saved["position"]
+        await player.connect(saved["voice_channel"])
+        controller.queue.extend(queue)
+        self.log.info(f"Restored {len(queue)} track{fmt_plur(len(queue))} for guild {gid}.")
+      except Exception as exc:
+        self._unrestored[gid] = saved
+        await self.teardown(int(gid))
+        self.log.error(f"Couldn't restore the queue of guild {gid}: {exc.__class__.__name__}: {exc}")
+
+    self._restored = True
+    self.save_queues.start()
+
+  def is_idle(self, controller: MusicController) -> bool:
+    """ Nothing playing (or paused), nothing queued, and nobody's used it in a while. """
+    player = self.bot._wavelink.players.get(controller.guild_id)
+    return (
+      (player is None or not player.is_playing or player.is_paused) and
+      not controller.queue and
+      time.monotonic() - controller.last_active > self._idle_timeout
+    )
+
+  def listeners(self, player: wavelink.Player) -> int:
+    """ People in the player's voice channel, besides us. """
+    if not player.is_connected or (channel := self.bot.get_channel(int(player.channel_id))) is None: return 0
+    return len([uid for uid in channel.voice_states if uid != self.bot.user.id])
+
+  async def teardown(self, guild_id: int):
+    """ Stops a guild's controller and player, and forgets them. """
+    if (controller := self.controllers.pop(guild_id, None)) is not None: controller.destroy()
+    self.bot.outbox.forget(("now playing", guild_id))
+    if (player := self.bot._wavelink.players.get(guild_id)) is not None:
+      try: await player.destroy()
+      except Exception as exc: self.log.error(f"Couldn't destroy player for guild {guild_id}: {exc}")
+
+  async def make_room(self) -> bool:
+    """ Whether there's room for another controller, reaping the least recently used idle one if needed. """
+    if len(self.controllers) < self._max_controllers: return True
+    idle = [c for c in self.controllers.values() if self.is_idle(c)]
+    if not idle: return False
+    await self.teardown(min(idle, key=lambda c: c.last_active).guild_id)
+    return True
+
+  @tasks.loop(seconds=60)
+  async def reap_controllers(self):
+    now = time.monotonic()
+    for gid, controller in list(self.controllers.items()):
+      player = self.bot._wavelink.players.get(gid)
+      if player is not None and player.is_connected and self.listeners(player) == 0:
+        if controller.empty_since is None: controller.empty_since = now
+      else:
+        controller.empty_since = None
+
+      if self.is_idle(controller):
+        self.log.info(f"Tearing down idle player for guild {gid}.")
+      elif controller.empty_since is not None and now - controller.empty_since > self._idle_timeout:
+        self.log.info(f"Leaving empty voice channel in guild {gid}.")
+      else:
+        continue
+      await self.teardown(gid)
+
+  @reap_controllers.before_loop
+  async def before_reap_controllers(self):
+    await self.bot.wait_until_ready()
+
+  # Moves players off degraded nodes, one per node per run, so the load
+  # figures can catch up before the next
+  @tasks.loop(seconds=REBALANCE_INTERVAL)
+  async def rebalance(self):
+    for node in list(self._nodes.values()):
+      if not node.players or (load := node_load(node)) < DEGRADED_LOAD: continue
+      best = self.best_node(exclude=node)
+      if best is None or node_load(best) * 2 > load: continue
+      self.log.warning(f"Lavalink node {node.identifier} is degraded (load {load:.0f}).")
+      await self.move_player(next(iter(node.players.values())), best)
+
+  @rebalance.before_loop
+  async def before_rebalance(self):
+    await self.bot.wait_until_ready()
 
   async def on_event_hook(self, event):
+    # Torn down players still send a last TrackEnd
+    if (controller := self.controllers.get(event.player.guild_id)) is None: return
     if isinstance(event, (wavelink.TrackEnd, wavelink.TrackException)):
-      controller = self.get_controller(event.player)
-      controller.next.set()
+      controller.track_ended()
+    elif isinstance(event, wavelink.TrackStart):
+      controller.track_started()
+
+  def record_gap(self, gap: float):
+    self._gaps.append(gap)
+    self.log.debug(f"Track handover took {gap * 1000:.0f}ms.")
+
+  async def get_tracks(self, query: str, *, refresh = False) -> Union[List[wavelink.Track], wavelink.TrackPlaylist, None]:
+    """ `wavelink.Client.get_tracks`, through the track cache. `refresh` skips the lookup, not the store. """
+    key = track_key(query)
+    if not refresh and (tracks := self._tracks.get(key)) is not None: return tracks
+
+    with self._telemetry.timer("rest.loadtracks"):
+      tracks = await self.bot._wavelink.get_tracks(key)
+    # Failed lookups aren't cached, they may be transient
+    if not tracks: return tracks
+
+    _tracks = tracks.tracks if isinstance(tracks, wavelink.TrackPlaylist) else tracks
+    self._tracks.set(key, tracks, STREAM_CACHE_TTL if any(t.is_stream for t in _tracks) else None)
+    return tracks
 
   def get_controller(self, value: Union[commands.Context, wavelink.Player]):
     if isinstance(value, commands.Context): gid = value.guild.id
@@ -143,7 +518,7 @@ class Music(Service):
     try:
       controller = self.controllers[gid]
     except KeyError:
-      controller = MusicController(self.bot, gid)
+      controller = MusicController(self, gid)
       self.controllers[gid] = controller
 
     return controller
@@ -154,12 +529,12 @@ class Music(Service):
     try:
       channel = ctx.author.voice.channel
     except AttributeError:
-      await ctx.send("Please join a channel first...", delete_after=10)
+      self.bot.outbox.notify(ctx.channel, "Please join a channel first...")
       raise discord.DiscordException()
       #FIXME probably use a diff exception here instead
 
-    player = self.bot._wavelink.get_player(ctx.guild.id)
-    await ctx.send(f"Joining __{channel.mention}__.", delete_after=10)
+    player = self.get_player(ctx.guild.id)
+    self.bot.outbox.notify(ctx.channel, f"Joining __{channel.mention}__.")
     await player.connect(channel.id)
 
     controller = self.get_controller(ctx)
@@ -169,74 +544,109 @@ class Music(Service):
   async def play(self, ctx: commands.Context, *, query: str):
     """ Play something. """
 
-    player = self.bot._wavelink.get_player(ctx.guild.id)
+    player = self.get_player(ctx.guild.id)
     if not player.is_connected:
       try: await ctx.invoke(self.join_voice)
       except discord.DiscordException: return
 
     if RURL.match(query):
-      tracks = await self.bot._wavelink.get_tracks(f"{query}")
-      if isinstance(tracks, wavelink.TrackPlaylist):
-        for t in tracks.tracks: await self.queue_track(ctx, t, nomessage=True)
-        await ctx.send(f"Added `{len(tracks.tracks)}` tracks to the queue.")
-      else:
-        await self.queue_track(ctx, tracks[0])
-    elif ctx.author.id in self._searchresults.keys() and re.match(r"^(10|[1-9])$", query):
+      await self.queue_url(ctx, query)
+    elif ctx.author.id in self._searchresults and re.match(r"^(10|[1-9])$", query):
       await self.check_searchresults(ctx.message)
     else:
-      if not (tracks := (await self.bot._wavelink.get_tracks(f"ytsearch:{query}"))[:10]):
-        await ctx.send("Couldn't find anything.", delete_after=10)
+      if not (tracks := (await self.get_tracks(f"ytsearch:{query}") or [])[:10]):
+        self.bot.outbox.notify(ctx.channel, "Couldn't find anything.")
       else:
-        list_msg = await ctx.send(
-          f"Results for \"{query}\":\n{fmt_tracklist(tracks)}"
+        list_msg = await self.bot.outbox.send(ctx.channel,
+          f"Results for \"{query}\":\n{fmt_tracklist(tracks)}",
+          delete_after=SEARCH_TTL
         )
 
-        if ctx.author.id in self._searchresults.keys():
-          await self._searchresults[ctx.author.id]["list_msg"].delete()
+        if (previous := self._searchresults.pop(ctx.author.id)) is not None:
+          await self.delete_quietly(previous["list_msg"])
 
-        self._searchresults[ctx.author.id] = {
+        self._searchresults.set(ctx.author.id, {
           "tracks": tracks,
           "list_msg": list_msg
-        }
+        })
+
+  async def queue_url(self, ctx: commands.Context, url: str):
+    """
+      Queues a track or a whole playlist. When a playlist link points at a
+      video, that video is resolved and queued on its own first, so it
+      starts playing while the (much slower) full playlist loads.
+    """
+    controller = self.get_controller(ctx)
+    first = progress = None
+
+    if RPLAYLIST.search(url) and (video := RVIDEO.search(url)) and track_key(url) not in self._tracks:
+      progress = await self.bot.outbox.send(ctx.channel, "Loading playlist...")
+      if tracks := await self.get_tracks(f"https://www.youtube.com/watch?v={video[1]}"):
+        first = tracks[0]
+        controller.queue.append(first)
+        await self.bot.outbox.edit(progress, f"Playing {escape_markdown(first.title)} first, loading the rest of the playlist...")
+
+    tracks = await self.get_tracks(url)
+    if isinstance(tracks, wavelink.TrackPlaylist):
+      info = tracks.data["playlistInfo"]
+      tracks = list(tracks.tracks)
+      # The linked video is already queued, drop its entry (just the one)
+      if first is not None:
+        selected = info.get("selectedTrack", -1)
+        if 0 <= selected < len(tracks) and tracks[selected].identifier == first.identifier:
+          del tracks[selected]
+        elif (i := next((i for i, t in enumerate(tracks) if t.identifier == first.identifier), None)) is not None:
+          del tracks[i]
+      # All in one go
+      controller.queue.extend(tracks)
+      count = len(tracks) + (first is not None)
+      content = f"Added `{count}` track{fmt_plur(count)} from **{escape_markdown(info['name'])}** to the queue."
+    elif first is not None:
+      content = f"Added to the queue: {escape_markdown(first.title)} (couldn't load the rest of the playlist)"
+    elif tracks:
+      controller.queue.append(tracks[0])
+      content = f"Added to the queue: {escape_markdown(tracks[0].title)}"
+    else:
+      content = "Couldn't find anything."
+
+    if progress is not None: await self.bot.outbox.edit(progress, content)
+    else:                    self.bot.outbox.notify(ctx.channel, content, delete_after=None)
 
   async def queue_track(self, ctx: commands.Context, track: wavelink.player.Track, *, nomessage = False):
     controller = self.get_controller(ctx)
-    controller.queue.put_nowait(track)
+    controller.queue.append(track)
     if not nomessage:
-      await ctx.send(f"Added to the queue: {escape_markdown(track.title)}")
-
-  async def listen_searchresults(self, message: discord.Message):
-    await self.check_searchresults(message)
-
-  async def check_searchresults(self, message: discord.Message):
-    if not (mid := message.author.id) in self._searchresults.keys(): return
-    if self._searchresults[mid]["list_msg"].channel != message.channel: return
-    if not (match := re.match(
-      fr"^({re.escape(self.bot.command_prefix)}(p(lay)?\s+)?)?(10|[1-9])$",
-      message.content)): return
-    track = self._searchresults[mid]["tracks"][int(match[4]) - 1]
-    await self._searchresults[mid]["list_msg"].delete()
-    del self._searchresults[mid]
+      self.bot.outbox.notify(ctx.channel, f"Added to the queue: {escape_markdown(track.title)}", delete_after=None)
+
+  async def check_searchresults(self, message: discord.Message, match: Optional[re.Match] = None):
+    if not (mid := message.author.id) in self._searchresults: return
+    results = self._searchresults.get(mid)
+    if results is None or results["list_msg"].channel != message.channel: return
+    if match is None and not (match := self._rpick.match(message.content)): return
+    track = results["tracks"][int(match[4]) - 1]
+    self._searchresults.pop(mid)
+    await self.delete_quietly(results["list_msg"])
     await self.queue_track(await self.bot.get_context(message), track)
 
+  async def delete_quietly(self, message: discord.Message):
+    # Search results delete themselves after a while
+    try: await message.delete()
+    except discord.NotFound: pass
+
   @commands.command(aliases=["q", "list"])
   async def queue(self, ctx: commands.Context, *, pagenum: int = 1):
     """ List queued tracks. """
     if pagenum < 1: return
 
-    player = self.bot._wavelink.get_player(ctx.guild.id) # type: wavelink.player.Player
+    player = self.get_player(ctx.guild.id) # type: wavelink.player.Player
     controller = self.get_controller(ctx)
 
-    if not player.current and not controller.queue._queue:
-      return await ctx.send("There's nothing in the queue...", delete_after=10)
+    if not player.current and not controller.queue:
+      return self.bot.outbox.notify(ctx.channel, "There's nothing in the queue...")
 
     if (_c := player.current) is not None:
       _p = player.position
-      time_remaining = time_hms(((_c.duration - _p) +
-        sum(map(lambda t: t.duration,
-          filter(lambda t: not t.is_stream, controller.queue._queue))
-        )
-      ) / 1000)
+      time_remaining = time_hms(((_c.duration - _p) + controller.queue.total) / 1000)
       _uri = _c.uri
       _title = _c.title
       _is_stream = _c.is_stream
@@ -258,137 +668,253 @@ class Music(Service):
       _out += f"`[STREAM]`"
     _out += f" {escape_markdown(_title)}\n<{_uri}>\n"
 
-    if controller.queue._queue:
-      qsize = controller.queue.qsize()
+    if controller.queue:
+      qsize = len(controller.queue)
       numpages = ceil(qsize / 10)
 
       if pagenum > numpages:
-        return await ctx.send(f"There's only {numpages} page{fmt_plur(numpages)} of tracks in the queue.", delete_after=10)
+        return self.bot.outbox.notify(ctx.channel, f"There's only {numpages} page{fmt_plur(numpages)} of tracks in the queue.")
 
-      tracks = list(islice(controller.queue._queue, (pagenum - 1) * 10, (pagenum - 1) * 10 + 10))
+      tracks = controller.queue.slice((pagenum - 1) * 10, pagenum * 10)
       if numpages > 1:
         _out += f"Page `{pagenum}/{numpages}` "
       _out += f"(`{qsize}` item{fmt_plur(qsize)}, `[{time_remaining}]` remaining)\n"
       _out += fmt_tracklist(tracks, page=pagenum)
     else:
       _out += "Nothing queued."
-    await ctx.send(_out)
+    await self.bot.outbox.send(ctx.channel, _out)
 
   @commands.command(aliases=["np", "what"])
   async def nowplaying(self, ctx: commands.Context):
     """ Get info for the current track. """
-    player = self.bot._wavelink.get_player(ctx.guild.id)
+    player = self.get_player(ctx.guild.id)
 
     if not player.current:
-      return await ctx.send("I'm not playing anything...", delete_after=10)
+      return self.bot.outbox.notify(ctx.channel, "I'm not playing anything...")
 
     _c = player.current # type: wavelink.Track
     _p = player.position
 
-    await ctx.send(_c.info["uri"])
+    await self.bot.outbox.send(ctx.channel, _c.info["uri"])
     _out = ""
     if not _c.is_stream:
       _out += f"`[{time_hms(_p / 1000)}/{time_hms(_c.length / 1000)}]`"
     else:
       _out += "`[STREAM]`"
     _out += f" {escape_markdown(_c.title)}\n"
-    await ctx.send(_out)
+    await self.bot.outbox.send(ctx.channel, _out)
 
   @commands.command(aliases=["s", "next"])
   async def skip(self, ctx: commands.Context, *, which: str = ""):
     """ Skip track(s). """
-    player = self.bot._wavelink.get_player(ctx.guild.id)
+    player = self.get_player(ctx.guild.id)
 
     if which == "":
       if not player.is_playing:
-        return await ctx.send("I'm not playing anything...", delete_after=10)
-      await ctx.send(f"Skipping {escape_markdown(player.current.title)}", delete_after=10)
+        return self.bot.outbox.notify(ctx.channel, "I'm not playing anything...")
+      self.bot.outbox.notify(ctx.channel, f"Skipping {escape_markdown(player.current.title)}")
       return await player.stop()
     elif match := re.match(r"^(\d+)(-(\d+))?$", which):
       a = int(match[1])
       if match[3]:
         b = int(match[3])
         if a == 0 or b == 0:
-          return await ctx.send("No 0s please...", delete_after=10)
+          return self.bot.outbox.notify(ctx.channel, "No 0s please...")
         if a > b:
-          return await ctx.send(f"Numbers that make sense, please...", delete_after=10)
+          return self.bot.outbox.notify(ctx.channel, f"Numbers that make sense, please...")
         if a == b:
           b = None
       else:
+        if a == 0:
+          return self.bot.outbox.notify(ctx.channel, "No 0s please...")
         b = None
 
       controller = self.get_controller(ctx)
+      if (a if b is None else b) > len(controller.queue):
+        return self.bot.outbox.notify(ctx.channel, f"There's only {len(controller.queue)} track{fmt_plur(len(controller.queue))} in the queue.")
       if b is not None:
-        controller.queue._queue = deque(
-          [i for _i, i in enumerate(controller.queue._queue) if _i + 1 not in range(a + 1, b + 1)])
-        await ctx.send(f"Skipped tracks {a}-{b}.", delete_after=10)
+        controller.queue.remove_range(a - 1, b)
+        self.bot.outbox.notify(ctx.channel, f"Skipped tracks {a}-{b}.")
       else:
-        _t = escape_markdown(controller.queue._queue[a].title)
-        controller.queue._queue = deque(
-          [i for _i, i in enumerate(controller.queue._queue) if _i + 1 != a])
-        await ctx.send(f"Skipped track {a}: {_t}", delete_after=10)
+        _t = escape_markdown(controller.queue.pop(a - 1).title)
+        self.bot.outbox.notify(ctx.channel, f"Skipped track {a}: {_t}")
+
+  @commands.command(aliases=["mv"])
+  async def move(self, ctx: commands.Context, src: int, dst: int):
+    """ Move a queued track to another position. """
+    controller = self.get_controller(ctx)
+    qsize = len(controller.queue)
+    if not (1 <= src <= qsize and 1 <= dst <= qsize):
+      return self.bot.outbox.notify(ctx.channel, f"There's only {qsize} track{fmt_plur(qsize)} in the queue.")
+
+    controller.queue.move(src - 1, dst - 1)
+    self.bot.outbox.notify(ctx.channel, f"Moved {escape_markdown(controller.queue[dst - 1].title)} to position {dst}.")
+
+  @commands.command()
+  async def gaps(self, ctx: commands.Context):
+    """ How long it takes to go from one track to the next. """
+    if not self._gaps:
+      return self.bot.outbox.notify(ctx.channel, "No tracks have finished yet...")
+
+    gaps = sorted(self._gaps)
+    await self.bot.outbox.send(ctx.channel,
+      f"Over the last `{len(gaps)}` track change{fmt_plur(len(gaps))}: " \
+      f"median `{statistics.median(gaps) * 1000:.0f}ms`, " \
+      f"95th percentile `{gaps[int(len(gaps) * 0.95)] * 1000:.0f}ms`, " \
+      f"worst `{gaps[-1] * 1000:.0f}ms`."
+    )
 
   @commands.command(aliases=["unresume"])
   async def pause(self, ctx: commands.Context):
     """ Pause the player. """
-    player = self.bot._wavelink.get_player(ctx.guild.id) # type: wavelink.Player
+    player = self.get_player(ctx.guild.id) # type: wavelink.Player
     if not player.is_playing or player.is_paused:
-      return await ctx.send("I'm not playing anything...", delete_after=10)
+      return self.bot.outbox.notify(ctx.channel, "I'm not playing anything...")
 
-    await ctx.send("Pausing.", delete_after=10)
+    self.bot.outbox.notify(ctx.channel, "Pausing.")
     await player.set_pause(True)
 
   @commands.command(aliases=["unpause", "continue"])
   async def resume(self, ctx: commands.Context):
     """ Resume the player from a paused state. """
-    player = self.bot._wavelink.get_player(ctx.guild.id)
+    player = self.get_player(ctx.guild.id)
     if not player.is_paused:
-      return await ctx.send("I'm not paused...", delete_after=10)
+      return self.bot.outbox.notify(ctx.channel, "I'm not paused...")
 
-    await ctx.send("Resuming.", delete_after=10)
+    self.bot.outbox.notify(ctx.channel, "Resuming.")
     await player.set_pause(False)
 
   @commands.command()
   async def volume(self, ctx: commands.Context, *, vol: int):
     """ Set the volume. """
-    player = self.bot._wavelink.get_player(ctx.guild.id)
+    player = self.get_player(ctx.guild.id)
     controller = self.get_controller(ctx)
 
     vol = max(min(vol, 1000), 0)
     controller.volume = vol
 
-    await ctx.send(f"Volume is now `{vol}%`.")
+    await self.bot.outbox.send(ctx.channel, f"Volume is now `{vol}%`.")
     await player.set_volume(vol)
 
   @commands.command(aliases=["disconnect", "dc", "leave", "stop", "kill", "die", "fuckoff"])
   async def destroy(self, ctx: commands.Context):
     """ Reset and disconnect. """
-    player = self.bot._wavelink.get_player(ctx.guild.id)
-
-    try: del self.controllers[ctx.guild.id]
-    except KeyError: return await player.disconnect()
-
-    await player.disconnect()
-    await ctx.send("Ok, bye!", delete_after=10)
-
-  # @commands.command()
-  # async def info(self, ctx: commands.Context):
-  #   """ Retrieve various Node/Server/Player information. """
-  #   player = self.bot._wavelink.get_player(ctx.guild.id)
-  #   node = player.node # type: wavelink.Node
-
-  #   used  = humanize.naturalsize(node.stats.memory_used)
-  #   total = humanize.naturalsize(node.stats.memory_allocated)
-  #   free  = humanize.naturalsize(node.stats.memory_free)
-  #   cpu   = node.stats.cpu_cores
-
-  #   fmt = f"**WaveLink:** `{wavelink.__version__}`\n\n" \
-  #     f"Connected to `{len(self.bot._wavelink.nodes)}` nodes.\n" \
-  #     f"Best available Node `{self.bot._wavelink.get_best_node().__repr__()}`\n" \
-  #     f"`{len(self.bot._wavelink.players)}` players are distributed on nodes.\n" \
-  #     f"`{node.stats.players}` players are distributed on server.\n" \
-  #     f"`{node.stats.playing_players}` players are playing on server.\n\n" \
-  #     f"Server Memory: `{used}/{total}` | `({free} free)`\n" \
-  #     f"Server CPU: `{cpu}`\n\n" \
-  #     f"Server Uptime: `{datetime.timedelta(milliseconds=node.stats.uptime)}`"
-  #   await ctx.send(fmt)
+    known = ctx.guild.id in self.controllers
+    await self.teardown(ctx.guild.id)
+    if known: self.bot.outbox.notify(ctx.channel, "Ok, bye!")
+
+  def player_state(self) -> Dict[str, dict]:
+    """ What every guild's player is up to, right now. """
+    state = {}
+    for gid, player in self.bot._wavelink.players.items():
+      controller = self.controllers.get(gid)
+      state[str(gid)] = {
+        "node":      player.node.identifier if player.node else None,
+        "connected": player.is_connected,
+        "playing":   player.is_playing,
+        "paused":    player.is_paused,
+        "position":  int(player.position) if player.current else None,
+        "queued":    len(controller.queue) if controller else 0,
+        "listeners": self.listeners(player),
+      }
+    return state
+
+  def telemetry_state(self) -> dict:
+    """ Everything ,telemetry knows, for machines. """
+    return {
+      "time":       time.time(),
+      "nodes":      {
+        name: { "connected": name in self._nodes, "restarts": lavalink.restarts }
+        for name, lavalink in self.bot._lavalink.items()
+      },
+      "players":    self.player_state(),
+      "summary":    self._telemetry.summary(),
+      "track_cache": self._tracks.stats(),
+      "outbox":     self.bot.outbox.stats(),
+      "handlers":   self.bot.message_handler_stats(),
+      "samples":    self._telemetry.dump(),
+    }
+
+  @tasks.loop(seconds=TELEMETRY_INTERVAL)
+  async def sample_telemetry(self):
+    record = self._telemetry.record
+    for name, node in list(self._nodes.items()):
+      if (stats := node.stats) is None: continue
+      record(f"node.{name}.memory_used",       stats.memory_used)
+      record(f"node.{name}.memory_allocated",  stats.memory_allocated)
+      # Heap in use, out of what -Xmx allows
+      record(f"node.{name}.memory_reservable", stats.memory_reservable)
+      record(f"node.{name}.heap_usage",        stats.memory_used / stats.memory_reservable if stats.memory_reservable else 0)
+      record(f"node.{name}.system_load",       stats.system_load)
+      record(f"node.{name}.lavalink_load",     stats.lavalink_load)
+      record(f"node.{name}.players",           stats.players)
+      record(f"node.{name}.playing_players",   stats.playing_players)
+      record(f"node.{name}.load",              node_load(node))
+      # Missing until a player has been running for a minute
+      if stats.frames_deficit != -1: record(f"node.{name}.frames_deficit", stats.frames_deficit)
+      if stats.frames_nulled  != -1: record(f"node.{name}.frames_nulled",  stats.frames_nulled)
+
+    players = self.player_state().values()
+    record("players.connected", len([p for p in players if p["connected"]]))
+    record("players.playing",   len([p for p in players if p["playing"] and not p["paused"]]))
+    record("players.paused",    len([p for p in players if p["paused"]]))
+    record("players.queued",    sum(p["queued"] for p in players))
+    record("controllers",       len(self.controllers))
+
+    await self.bot.loop.run_in_executor(None, write_json, self._telemetry_path, self.telemetry_state())
+
+  @sample_telemetry.before_loop
+  async def before_sample_telemetry(self):
+    await self.bot.wait_until_ready()
+
+  @commands.group(aliases=["info", "stats"], invoke_without_command=True)
+  @commands.check(is_operator)
+  async def telemetry(self, ctx: commands.Context):
+    """ Lavalink node, player and lookup stats. """
+    summary = self._telemetry.summary()
+    def stat(name: str, key: str, fmt = lambda v: f"{v:.0f}") -> str:
+      if (value := summary.get(name, {}).get(key)) is None: return "?"
+      return fmt(value)
+    pct = lambda v: f"{v * 100:.0f}%"
+    ms  = lambda v: f"{v * 1000:.0f}ms"
+
+    _out = f"**Wavelink** `{wavelink.__version__}`, `{len(self._nodes)}/{len(self.bot._lavalink)}` node{fmt_plur(len(self.bot._lavalink))} connected\n"
+    for name, lavalink in self.bot._lavalink.items():
+      p = f"node.{name}"
+      if name not in self._nodes:
+        _out += fmt_list([f"`{name}`: down (`{lavalink.restarts}` restart{fmt_plur(lavalink.restarts)})"])
+        continue
+      _out += fmt_list([
+        f"`{name}`: " \
+        f"heap `{stat(f'{p}.memory_used', 'last', fmt_mib)}/{stat(f'{p}.memory_reservable', 'last', fmt_mib)}` " \
+        f"(peak `{stat(f'{p}.heap_usage', 'max', pct)}`), " \
+        f"CPU `{stat(f'{p}.lavalink_load', 'last', pct)}` (system `{stat(f'{p}.system_load', 'last', pct)}`), " \
+        f"`{stat(f'{p}.playing_players', 'last')}/{stat(f'{p}.players', 'last')}` playing, " \
+        f"frame deficit `{stat(f'{p}.frames_deficit', 'last')}` (95th percentile `{stat(f'{p}.frames_deficit', 'p95')}`), " \
+        f"`{lavalink.restarts}` restart{fmt_plur(lavalink.restarts)}"
+      ])
+
+    _out += f"\n**Players** `{stat('players.connected', 'last')}` connected, " \
+      f"`{stat('players.playing', 'last')}` playing (peak `{stat('players.playing', 'max')}`), " \
+      f"`{stat('players.queued', 'last')}` tracks queued\n"
+
+    _out += "\n**Lookups**\n"
+    for name in ("rest.loadtracks", "rest.decodetracks"):
+      _out += fmt_list([
+        f"`{name[5:]}`: `{stat(name, 'count')}` recent, median `{stat(name, 'median', ms)}`, " \
+        f"95th percentile `{stat(name, 'p95', ms)}`, worst `{stat(name, 'max', ms)}`"
+      ])
+    cache = self._tracks.stats()
+    lookups = cache["hits"] + cache["misses"]
+    _out += fmt_list([
+      f"Track cache: `{cache['size']}/{cache['maxsize']}` entries, " \
+      f"`{cache['hits'] / lookups * 100 if lookups else 0:.0f}%` hits"
+    ])
+    await self.bot.outbox.send(ctx.channel, _out)
+
+  @telemetry.command(name="dump")
+  @commands.check(is_operator)
+  async def telemetry_dump(self, ctx: commands.Context):
+    """ Everything, as JSON. """
+    data = json.dumps(self.telemetry_state(), indent=2).encode("utf-8")
+    await self.bot.outbox.send(ctx.channel, "", file=discord.File(io.BytesIO(data), "telemetry.json"))
@@ -1,27 +1,143 @@
 import json
 import datetime
+import calendar
+import time
 import re
+from functools import lru_cache
+from asyncio import Semaphore, gather
+from typing import Optional, Tuple, Union
 
 import jsonschema
-from discord import AllowedMentions, Member
+from discord import AllowedMentions, Member, TextChannel, Forbidden, NotFound
 from discord.ext import commands, tasks
-import dateparser
+from tinydb.table import Table
 
-from lib.utils.etc import Service, react, readable_delta, TIME_FORMAT
+from lib.utils.etc import Service, react, readable_delta, epoch_str, str_epoch
+from lib.utils.deadlines import Deadlines
 from lib.utils.checks import is_mod, in_guild
-from lib.utils.text import fmt_list_item, fmt_code
+from lib.utils.text import fmt_list_item, fmt_code, fmt_plur, MESSAGE_LIMIT
 
 dateparser_settings = {
   "TIMEZONE": "Etc/UTC",
+  "RETURN_AS_TIMEZONE_AWARE": True,
   "DATE_ORDER": "YMD",
   "PREFER_DATES_FROM": "future",
   "PREFER_DAY_OF_MONTH": "current",
 }
 
-def remsort(now: datetime):
-  def _remsort(reminder):
-    return - (now - datetime.datetime.strptime(reminder["datetime"], TIME_FORMAT))
-  return _remsort
+# Width of the due-time index buckets, in seconds
+BUCKET = 60 * 60
+# Furthest ,rem upcoming looks ahead, in hours; every bucket in between is visited
+UPCOMING_MAX = 24 * 366
+# Channels announced to at once
+ANNOUNCE_CONCURRENCY = 8
+# Seconds before retrying an announcement that failed
+RETRY = 60
+
+# Time expressions
+# The common forms are handled by the grammar below. Anything else falls
+# through to dateparser, which is slow and heavy, so it's imported lazily.
+UNITS = {
+  "s": 1,      "sec": 1,     "secs": 1,    "second": 1, "seconds": 1,
+  "m": 60,     "min": 60,    "mins": 60,   "minute": 60, "minutes": 60,
+  "h": 3600,   "hr": 3600,   "hrs": 3600,  "hour": 3600, "hours": 3600,
+  "d": 86400,  "day": 86400, "days": 86400,
+  "w": 604800, "wk": 604800, "wks": 604800, "week": 604800, "weeks": 604800,
+}
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+# "in 2 hours", "in 3d 4h", "1 hour and 30 minutes"
+# Only real units, so "5pm" is left to the absolute forms
+RUNIT = "|".join(sorted(UNITS, key=len, reverse=True))
+RRELATIVE = re.compile(rf"^(?:in\s+)?((?:\d+\s*(?:{RUNIT})(?:,?\s*(?:and\s+)?|$))+)$")
+RRELATIVE_PART = re.compile(rf"(\d+)\s*({RUNIT})")
+# "tomorrow 14:00", "next friday at 5pm", "2021-06-01 09:30", "at 18:00"
+RABSOLUTE = re.compile(
+  r"^(?:(?P<day>today|tomorrow)|(?:next\s+)?(?P<weekday>" + "|".join(WEEKDAYS) + r")|(?P<date>\d{4}-\d{2}-\d{2}))?"
+  r"(?:(?:^|\s+|(?<=\d)t)(?:at\s+)?(?P<hour>\d{1,2})(?::(?P<minute>\d{2})(?::(?P<second>\d{2}))?)?\s*(?P<ampm>am|pm)?)?$")
+
+def normalize_when(text: str) -> str:
+  """ Lowercases and collapses whitespace in a time expression. """
+  return " ".join(text.lower().split())
+
+def parse_when_fast(text: str, now: int) -> Optional[int]:
+  """
+    Parses the common time expressions into a UTC epoch, without dateparser.
+    `text` should already be normalized. Returns None if it doesn't match.
+  """
+  if match := RRELATIVE.match(text):
+    total = 0
+    for amount, unit in RRELATIVE_PART.findall(match[1]):
+      total += int(amount) * UNITS[unit]
+    return now + total
+
+  if not (match := RABSOLUTE.match(text)) or not text: return None
+
+  today = datetime.datetime.utcfromtimestamp(now)
+  if match["date"]:
+    try:    day = datetime.datetime.strptime(match["date"], "%Y-%m-%d")
+    except ValueError: return None
+  elif match["day"] == "tomorrow":
+    day = today + datetime.timedelta(days=1)
+  elif match["weekday"]:
+    day = today + datetime.timedelta(days=(WEEKDAYS.index(match["weekday"]) - today.weekday() - 1) % 7 + 1)
+  else:
+    day = today
+
+  if match["hour"] is None:
+    # Day words keep the current time of day, dates start at midnight
+    if match["date"]: return calendar.timegm(day.date().timetuple())
+    return calendar.timegm(day.timetuple())
+
+  # A lone number isn't a time
+  if match["minute"] is None and match["ampm"] is None: return None
+
+  hour = int(match["hour"])
+  if match["ampm"]:
+    if not 1 <= hour <= 12: return None
+    hour = hour % 12 + (12 if match["ampm"] == "pm" else 0)
+  try:
+    then = datetime.datetime.combine(day.date(), datetime.time(
+      hour, int(match["minute"] or 0), int(match["second"] or 0)))
+  except ValueError: return None
+
+  due = calendar.timegm(then.timetuple())
+  # A bare time means its next occurrence
+  if not (match["date"] or match["day"] or match["weekday"]) and due <= now:
+    due += 86400
+  return due
+
+# Marks the relative base, so results taken from it can be told apart from
+# absolute ones (which dateparser returns with no microseconds)
+RELATIVE_MARK = 123457
+
+@lru_cache(maxsize=256)
+def _parse_when_slow(text: str, minute: int, languages: Tuple[str, ...]) -> Optional[Tuple[int, bool]]:
+  """
+    Cached per minute, so relative results are returned as an offset from
+    the start of that minute, to be added to the exact time; absolute ones
+    as a UTC epoch. Says which with the second item.
+  """
+  import dateparser
+  when = dateparser.parse(text, languages=list(languages), settings={
+    **dateparser_settings,
+    "RELATIVE_BASE": datetime.datetime.utcfromtimestamp(minute * 60).replace(microsecond=RELATIVE_MARK),
+  })
+  if when is None: return None
+  if when.microsecond == RELATIVE_MARK: return int(when.timestamp()) - minute * 60, True
+  return int(when.timestamp()), False
+
+def parse_when(text: str, now: int, languages: Tuple[str, ...] = ("en",)) -> Optional[int]:
+  """ Parses a time expression into a UTC epoch, or returns None. """
+  text = normalize_when(text)
+  if (due := parse_when_fast(text, now)) is not None: return due
+  if (parsed := _parse_when_slow(text, now // 60, languages)) is None: return None
+  when, relative = parsed
+  return int(now) + when if relative else when
+
+def remsort(reminder: dict) -> int:
+  """ Sort key, soonest first. """
+  return reminder["datetime"]
 
 def remshort(reminder: dict):
   _lines = reminder["message"].split("\n")
@@ -30,11 +146,53 @@ def remshort(reminder: dict):
   elif len(_lines) > 1: return msg + " (…)"
   return msg
 
+def migrate_reminders(table: Table) -> int:
+  """
+    Rewrites reminders still using `TIME_FORMAT` strings to UTC epochs, in
+    one write. Returns how many were migrated.
+  """
+  stale = [r.doc_id for r in table.all() if isinstance(r["datetime"], str)]
+
+  def to_epoch(reminder: dict):
+    reminder["datetime"] = str_epoch(reminder["datetime"])
+    reminder["meta"]["datetime"] = str_epoch(reminder["meta"]["datetime"])
+
+  if stale: table.update(to_epoch, doc_ids=stale)
+  return len(stale)
+
+def fmt_reminders(reminders: list, *, members: bool = False) -> str:
+  out = ""
+  now = int(time.time())
+  for reminder in sorted(reminders, key=remsort):
+    msg = remshort(reminder)
+
+    out += fmt_list_item(
+      f"{fmt_code(str(reminder.doc_id).rjust(3))} - " +
+      f"{fmt_code(epoch_str(reminder['datetime']))}, " +
+      f"{readable_delta(datetime.timedelta(seconds=now - reminder['datetime']))}" +
+      (f" (<@{reminder['meta']['member']}>)" if members else "") + ":\n" +
+      f"    {msg}"
+    )
+  return out
+
 class Reminder(Service):
   def __init__(self, bot: commands.Bot):
     super().__init__(bot)
-    self._reminders = bot._db.table("reminders")
+    # Before anything is mirrored, the indexes expect epochs
+    if migrated := migrate_reminders(bot._db.table("reminders")):
+      self.log.info(f"Migrated {migrated} reminder{fmt_plur(migrated)} to epoch times.")
+    self._reminders = bot._storage.table("reminders",
+      member  = lambda r: r["meta"]["member"],
+      channel = lambda r: r["channel"],
+      due     = lambda r: r["datetime"] // BUCKET)
     self._reminder_schema = json.load(open("./lib/schema/reminder.json"))
+    self._languages = tuple(bot._config.get("reminder_languages", ["en"]))
+
+    # Due times, loaded once and kept in sync by the commands below
+    self._due = Deadlines(time.time)
+    self._announce_limit = Semaphore(ANNOUNCE_CONCURRENCY)
+    for reminder in self._reminders.all():
+      self._due.push(reminder.doc_id, reminder["datetime"])
 
     self.tick.start()
 
@@ -46,25 +204,27 @@ class Reminder(Service):
   @commands.group(aliases=["rem"], invoke_without_command=True)
   async def reminder(self, ctx: commands.Context, *, reminder: str):
     """ Set a reminder, ie ",rem in 2 hours: Wake up!" """
-    match = re.match("\A([^:\n]+):\s?(.+)\Z", reminder, re.S)
+    # Colons between digits belong to the time, ie "tomorrow 14:00: Lunch"
+    match = re.match("\A((?:[^:\n]|(?<=\d):(?=\d\d))+):\s?(.+)\Z", reminder, re.S)
     if match:
       try:
-        when = dateparser.parse(match[1])
+        now = int(time.time())
+        due = parse_when(match[1], now, self._languages)
 
         # Issue in parsing
-        if when is None:
+        if due is None:
           await react(ctx, "deny")
           return await ctx.reply("Sorry, but I couldn't parse that.", delete_after=10, mention_author=False)
 
-        duration = when - datetime.datetime.utcnow()
+        duration = due - now
 
         # Past date
-        if duration <= datetime.timedelta(0):
+        if duration <= 0:
           await react(ctx, "deny")
           return await ctx.reply("I can't go back in time.", delete_after=10, mention_author=False)
 
         # Date exceeding 5 years
-        if duration > datetime.timedelta(days = 365.25 * 5):
+        if duration > 365.25 * 5 * 24 * 60 * 60:
           await react(ctx, "deny")
           return await ctx.reply("That's way too long.", delete_after=10, mention_author=False)
 
@@ -76,28 +236,25 @@ class Reminder(Service):
       msg = match[2].strip()
       # ./lib/schema/reminder.json
       new_reminder = {
-        "datetime": when.strftime(TIME_FORMAT),
+        "datetime": due,
         "channel": ctx.message.channel.id,
         "message": msg,
         "meta": {
           "message": ctx.message.id,
           "member": ctx.message.author.id,
-          "datetime": ctx.message.created_at.strftime(TIME_FORMAT)
+          # discord.py gives naive UTC datetimes
+          "datetime": calendar.timegm(ctx.message.created_at.utctimetuple())
         }
       }
 
-  	  # FIXME There is a timezone-related issue... SOMEWHERE in this file.
-      # All reminders are one hour sooner than they should be.
-      self.log.debug(f"Now:  {datetime.datetime.utcnow().strftime(TIME_FORMAT)}")
-      self.log.debug(f"Then: {new_reminder['datetime']}")
-      self.log.debug(f"Diff: {datetime.datetime.strptime(new_reminder['datetime'], TIME_FORMAT) - datetime.datetime.utcnow()}")
-      self.log.debug(f"Pending? {datetime.datetime.strptime(new_reminder['datetime'], TIME_FORMAT) - datetime.datetime.utcnow() <= datetime.timedelta(0)}")
+      self.log.debug(f"New reminder due at {epoch_str(due)} (in {duration}s)")
 
       try:
         # Validation step just in case
         jsonschema.validate(instance=new_reminder, schema=self._reminder_schema)
         # Add to table
-        self._reminders.insert(new_reminder)
+        doc_id = await self._reminders.insert(new_reminder)
+        self._due.push(doc_id, due)
         # UI feedback
         await react(ctx, "confirm")
       # Error handling
@@ -113,67 +270,53 @@ class Reminder(Service):
   @reminder.command(aliases=["l"])
   async def list(self, ctx: commands.Context):
     """ See all your reminders. """
-    out = ""
-    your_reminders = sorted(
-      filter(
-        lambda reminder: reminder["meta"]["member"] == ctx.author.id,
-        self._reminders.all()
-      ),
-      key=remsort(datetime.datetime.utcnow())
-    )
+    your_reminders = self._reminders.lookup("member", ctx.author.id)
 
     if len(your_reminders) == 0:
       await ctx.reply("You don't have any reminders set.", mention_author=False)
     else:
-      for reminder in your_reminders:
-        then = datetime.datetime.strptime(reminder["datetime"], TIME_FORMAT)
-        msg = remshort(reminder)
-
-        out += fmt_list_item(
-          f"{fmt_code(str(reminder.doc_id).rjust(3))} - " +
-          f"{fmt_code(reminder['datetime'])}, " +
-          f"{readable_delta(datetime.datetime.utcnow() - then)}:\n" +
-          f"    {msg}"
-        )
-
-      await ctx.reply(out, allowed_mentions=AllowedMentions.none(), mention_author=False)
+      await ctx.reply(fmt_reminders(your_reminders), allowed_mentions=AllowedMentions.none(), mention_author=False)
 
   @reminder.command(aliases=["la"])
   @commands.check(is_mod)
-  async def listall(self, ctx: commands.Context):
-    """ (Restricted to moderators) List all reminders. """
+  async def listall(self, ctx: commands.Context, *, target: Optional[Union[Member, TextChannel]] = None):
+    """ (Restricted to moderators) List all reminders, or those of a member or channel. """
+    if   target is None:               reminders = self._reminders.all()
+    elif isinstance(target, Member):   reminders = self._reminders.lookup("member", target.id)
+    else:                              reminders = self._reminders.lookup("channel", target.id)
 
-    if len(self._reminders.all()) == 0:
+    if len(reminders) == 0:
       await ctx.reply("There are no reminders.", delete_after=10, mention_author=False)
       return
 
-    out = ""
-    for reminder in sorted(self._reminders.all(), key=remsort(datetime.datetime.utcnow())):
-      then = datetime.datetime.strptime(reminder["datetime"], TIME_FORMAT)
-      msg = remshort(reminder)
+    await ctx.reply(fmt_reminders(reminders, members=True), allowed_mentions=AllowedMentions.none(), mention_author=False)
+
+  @reminder.command(aliases=["u"])
+  @commands.check(is_mod)
+  async def upcoming(self, ctx: commands.Context, hours: int = 24):
+    """ (Restricted to moderators) List reminders due in the next few hours. """
+    hours = min(max(hours, 0), UPCOMING_MAX)
+    now = time.time()
+    until = now + hours * 3600
+    reminders = [
+      reminder
+      for bucket in range(int(now // BUCKET), int(until // BUCKET) + 1)
+      for reminder in self._reminders.lookup("due", bucket)
+      if reminder["datetime"] <= until
+    ]
 
-      out += fmt_list_item(
-        f"{fmt_code(str(reminder.doc_id).rjust(3))} - " +
-        f"{fmt_code(reminder['datetime'])}, " +
-        f"{readable_delta(datetime.datetime.utcnow() - then)} " +
-        f"(<@{reminder['meta']['member']}>):\n"
-        f"    {msg}"
-      )
+    if len(reminders) == 0:
+      await ctx.reply(f"No reminders due in the next {hours} hour{fmt_plur(hours)}.", delete_after=10, mention_author=False)
+      return
 
-    await ctx.reply(out, allowed_mentions=AllowedMentions.none(), mention_author=False)
+    await ctx.reply(fmt_reminders(reminders, members=True), allowed_mentions=AllowedMentions.none(), mention_author=False)
 
   @reminder.command()
   @commands.check(is_mod)
   async def purge(self, ctx: commands.Context, user: Member):
     """ (Restricted to moderators) Purge all of a user's reminders. """
-    rems = list(map(
-      lambda r: r.doc_id,
-      filter(
-        lambda r: r["meta"]["member"] == user.id,
-        self._reminders.all()
-      )
-    ))
-    self._reminders.remove(doc_ids=rems)
+    rems = await self._reminders.remove(self._reminders.ids("member", user.id))
+    for doc_id in rems: self._due.discard(doc_id)
     await react(ctx, "confirm")
     await ctx.reply(f"Purged {len(rems)} reminders.", delete_after=10, mention_author=False)
 
@@ -183,7 +326,8 @@ class Reminder(Service):
     """ (Restricted to moderators) Delete any reminder. """
     reminder = self._reminders.get(doc_id=reminder_id)
     if reminder is not None:
-      self._reminders.remove(doc_ids=[reminder_id])
+      await self._reminders.remove([reminder_id])
+      self._due.discard(reminder_id)
       await react(ctx, "confirm")
     else:
       await react(ctx, "deny")
@@ -195,7 +339,8 @@ class Reminder(Service):
     reminder = self._reminders.get(doc_id=reminder_id)
     if reminder is not None:
       if reminder["meta"]["member"] == ctx.author.id:
-        self._reminders.remove(doc_ids=[reminder_id])
+        await self._reminders.remove([reminder_id])
+        self._due.discard(reminder_id)
         await react(ctx, "confirm")
       else:
         await react(ctx, "deny")
@@ -204,21 +349,81 @@ class Reminder(Service):
       await react(ctx, "deny")
       await ctx.reply("That's not a reminder.", delete_after=10, mention_author=False)
 
-  async def announce_reminder(self, reminder: dict):
-    await self.bot._guild.get_channel(reminder["channel"]).send(
+  def fmt_announcement(self, reminder: dict, now: int) -> str:
+    return (
       f"Reminder for <@{reminder['meta']['member']}> " +
-      f"({readable_delta(datetime.datetime.utcnow() - datetime.datetime.strptime(reminder['meta']['datetime'], TIME_FORMAT))}):\n" +
+      f"({readable_delta(datetime.timedelta(seconds=now - reminder['meta']['datetime']))}):\n" +
       f"{reminder['message']}\n" +
       f"https://discord.com/channels/{self.bot._guild.id}/{reminder['channel']}/{reminder['meta']['message']}"
     )
 
-  @tasks.loop(seconds=1)
+  async def announce_reminders(self, channel_id: int, reminders: list) -> list:
+    """
+      Sends a channel's due reminders, merged into as few messages as
+      possible. Returns the doc ids that are done with, delivered or not.
+    """
+    channel = self.bot._guild.get_channel(channel_id)
+    if channel is None:
+      self.log.warning(f"Dropping {len(reminders)} reminder{fmt_plur(len(reminders))} for missing channel {channel_id}.")
+      return [r.doc_id for r in reminders]
+
+    # Pack the announcements into as few messages as fit
+    now = int(time.time())
+    batches = [] # [[text, doc_ids]]
+    for reminder in sorted(reminders, key=remsort):
+      part = self.fmt_announcement(reminder, now)[:MESSAGE_LIMIT]
+      if batches and len(batches[-1][0]) + 1 + len(part) <= MESSAGE_LIMIT:
+        batches[-1][0] += "\n" + part
+        batches[-1][1].append(reminder.doc_id)
+      else:
+        batches.append([part, [reminder.doc_id]])
+
+    done = []
+    async with self._announce_limit:
+      for i, (text, doc_ids) in enumerate(batches):
+        try:
+          await channel.send(text)
+        except (Forbidden, NotFound) as exc:
+          self.log.warning(f"Dropping reminders for channel {channel_id}: {exc}")
+          return done + [doc_id for _, ids in batches[i:] for doc_id in ids]
+        except Exception as exc:
+          # Network errors too, so one channel can't hold up the others
+          self.log.error(f"Couldn't announce reminders in channel {channel_id}, retrying in {RETRY}s: {exc!r}")
+          for _, ids in batches[i:]:
+            for doc_id in ids: self._due.push(doc_id, now + RETRY)
+          return done
+        done += doc_ids
+    return done
+
+  # Sleeps until the earliest reminder is due, rather than polling
+  @tasks.loop(seconds=0)
   async def tick(self):
-    # Check all reminders
-    for reminder in self._reminders.all():
-      # If they are pending
-      if datetime.datetime.strptime(reminder["datetime"], TIME_FORMAT) - datetime.datetime.utcnow() <= datetime.timedelta(0):
-        # Announce them
-        await self.announce_reminder(reminder)
-        # And then remove them from the table
-        self._reminders.remove(doc_ids=[reminder.doc_id])
+    await self._due.wait()
+
+    # Group due reminders per channel
+    channels = {}
+    for doc_id in self._due.pop_due():
+      reminder = self._reminders.get(doc_id=doc_id)
+      if reminder is None: continue
+      channels.setdefault(reminder["channel"], []).append(reminder)
+    if not channels: return
+
+    # Announce them, channels concurrently
+    results = await gather(*(
+      self.announce_reminders(channel_id, reminders)
+      for channel_id, reminders in channels.items()
+    ), return_exceptions=True)
+    done = []
+    for (channel_id, reminders), result in zip(channels.items(), results):
+      if not isinstance(result, Exception):
+        done += result
+        continue
+      self.log.error(f"Announcing reminders in channel {channel_id} failed, retrying in {RETRY}s: {result!r}")
+      for reminder in reminders: self._due.push(reminder.doc_id, int(time.time()) + RETRY)
+    # And then remove the delivered ones from the table, in one write
+    await self._reminders.remove(done)
+
+  def cog_unload(self):
+    # Cancel task when unloading the cog
+    self.tick.cancel()
+    self._reminders.flush()
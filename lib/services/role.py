@@ -1,6 +1,5 @@
 from discord import Role as dRole, AllowedMentions
 from discord.ext import commands
-from tinydb import where
 
 from lib.utils.etc import Service, react
 from lib.utils.checks import is_mod, in_guild
@@ -9,7 +8,10 @@ from lib.utils.text import fmt_list
 class Role(Service):
   def __init__(self, bot: commands.Bot):
     super().__init__(bot)
-    self._roles = bot._db.table("roles")
+    # Indexed by role id, so checking a role is O(1)
+    self._roles = bot._storage.table("roles", id=lambda r: r["id"])
+    # Rendered ,role list, dropped whenever the registry changes
+    self._list_message = None
 
     self.bot.add_listener(self.catch_role_delete, "on_guild_role_delete")
 
@@ -17,10 +19,14 @@ class Role(Service):
   async def cog_check(self, ctx: commands.Context):
     return in_guild(ctx)
 
+  def is_registered(self, role: dRole) -> bool:
+    return bool(self._roles.ids("id", role.id))
+
   async def catch_role_delete(self, role: dRole):
-    if self._roles.search(where("id") == role.id):
-      self._roles.remove(where("id") == role.id)
-      await self.bot.notice_channel.send(f":x: Previously registered role deleted: {role.name} ({role.id})")
+    if doc_ids := self._roles.ids("id", role.id):
+      await self._roles.remove(doc_ids)
+      self._list_message = None
+      await self.bot._notice_channel.send(f":x: Previously registered role deleted: {role.name} ({role.id})")
 
   @commands.group(aliases=["r"])
   async def role(self, ctx: commands.Context):
@@ -30,7 +36,7 @@ class Role(Service):
   @role.command(aliases=["a"])
   async def add(self, ctx: commands.Context, *, role: dRole):
     """ Assign yourself a role. """
-    if self._roles.search(where("id") == role.id):
+    if self.is_registered(role):
       await ctx.author.add_roles(role)
       await react(ctx, "confirm")
     else:
@@ -40,7 +46,7 @@ class Role(Service):
   @role.command(aliases=["r"])
   async def remove(self, ctx: commands.Context, *, role: dRole):
     """ Remove a role you have. """
-    if self._roles.search(where("id") == role.id):
+    if self.is_registered(role):
       if role in ctx.author.roles:
         await ctx.author.remove_roles(role)
         await react(ctx, "confirm")
@@ -55,19 +61,21 @@ class Role(Service):
   @commands.check(is_mod)
   async def register(self, ctx: commands.Context, *, role: dRole):
     """ (Restricted to moderators) Register a role. """
-    if self._roles.search(where("id") == role.id):
+    if self.is_registered(role):
       await react(ctx, "confused")
       await ctx.reply("Role already registered.", delete_after=10, mention_author=False)
     else:
-      self._roles.insert({ "id": role.id })
+      await self._roles.insert({ "id": role.id })
+      self._list_message = None
       await react(ctx, "confirm")
 
   @role.command(aliases=["dereg"])
   @commands.check(is_mod)
   async def deregister(self, ctx: commands.Context, *, role: dRole):
     """ (Restricted to moderators) Deregister a role. """
-    if self._roles.search(where("id") == role.id):
-      self._roles.remove(where("id") == role.id)
+    if doc_ids := self._roles.ids("id", role.id):
+      await self._roles.remove(doc_ids)
+      self._list_message = None
       await react(ctx, "confirm")
     else:
       await react(ctx, "confused")
@@ -87,15 +95,18 @@ class Role(Service):
       await react(ctx, "confused")
       await ctx.reply(error, delete_after=10, mention_author=False)
 
+  def cog_unload(self):
+    self._roles.flush()
+
   @role.command(aliases=["l"])
   async def list(self, ctx: commands.Context):
     """ List all the self-assignable roles """
-    roles = \
-      map(lambda r: ctx.bot._guild.get_role(r["id"]).mention,
-        self._roles)
-    await ctx.send(
-      "**List of self-assignable roles:**\n" +
-      fmt_list(roles) + "\n" +
-      "If you'd like a role added (especially pronouns), ask a moderator!",
-      allowed_mentions=AllowedMentions.none()
-    )
+    if self._list_message is None:
+      roles = \
+        map(lambda r: ctx.bot._guild.get_role(r["id"]).mention,
+          self._roles)
+      self._list_message = \
+        "**List of self-assignable roles:**\n" + \
+        fmt_list(roles) + "\n" + \
+        "If you'd like a role added (especially pronouns), ask a moderator!"
+    await ctx.send(self._list_message, allowed_mentions=AllowedMentions.none())
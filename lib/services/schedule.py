@@ -1,26 +1,58 @@
 import json
+import time
+from asyncio import Semaphore, create_task
+from typing import Tuple
 
 import jsonschema
 from discord.ext import commands, tasks
-from asyncio import create_task as await_this
-import schedule
+from tinydb.table import Table
 
-from lib.utils.etc import Service, react, TIME_FORMAT
+from lib.utils.etc import Service, react, epoch_str
+from lib.utils.deadlines import Deadlines
+from lib.utils.timespec import compile_when, fmt_when, from_directive
 from lib.utils.checks import is_mod, in_guild
-from lib.utils.text import fmt_list, fmt_code
+from lib.utils.text import fmt_list, fmt_code, fmt_plur
 
-#TODO: add remove to sch
 #TODO: add purge handling
 
+# Task sends in flight at once
+SEND_CONCURRENCY = 4
+
+def migrate_tasks(table: Table) -> Tuple[int, int]:
+  """
+    Rewrites tasks still using `schedule` module directives to declarative
+    specs, in one write. Returns how many were migrated, and how many have
+    no equivalent (those are left alone, and not scheduled).
+  """
+  legacy = [t for t in table.all() if "directive" in t and "when" not in t]
+  migrated = [t.doc_id for t in legacy if from_directive(t["directive"]) is not None]
+
+  def to_spec(task: dict):
+    task["when"] = from_directive(task.pop("directive"))
+
+  if migrated: table.update(to_spec, doc_ids=migrated)
+  return len(migrated), len(legacy) - len(migrated)
+
 class Schedule(Service):
   def __init__(self, bot: commands.Bot):
     super().__init__(bot)
-    self._schedule = bot._db.table("schedule")
+    migrated, failed = migrate_tasks(bot._db.table("schedule"))
+    if migrated: self.log.info(f"Migrated {migrated} task{fmt_plur(migrated)} to schedule specs.")
+    if failed:   self.log.warning(f"{failed} task{fmt_plur(failed)} use directives with no equivalent spec, skipping.")
+
+    self._schedule = bot._storage.table("schedule")
     self._schedule_task_schema = json.load(open("./lib/schema/schedule_task.json"))
 
+    # Next fire times, and how to get the one after
+    self._due = Deadlines(time.time)
+    self._next = {}
+    self._send_limit = Semaphore(SEND_CONCURRENCY)
+    self._inflight = set()
+
     # Set up all saved tasks
+    now = int(time.time())
     for task in self._schedule.all():
-      self.setup_task(task)
+      if "when" in task: self.setup_task(task.doc_id, task, now)
 
     self.tick.start()
 
@@ -28,23 +60,33 @@ class Schedule(Service):
   async def cog_check(self, ctx: commands.Context):
     return in_guild(ctx) and is_mod(ctx)
 
-  # Set up one task
-  def setup_task(self, task):
-    def task_message(channel, message):
-      await_this(channel.send(message))
+  # Set up one task; bad stored ones are logged and left unscheduled,
+  # rather than keeping the bot from starting
+  def setup_task(self, doc_id: int, task: dict, now: int):
+    try:
+      self._next[doc_id] = compile_when(task["when"])
+      self._due.push(doc_id, self._next[doc_id](now))
+    except Exception as exc:
+      self._next.pop(doc_id, None)
+      self.log.error(f"Couldn't schedule task {doc_id}, skipping it: {exc}")
 
-    if task["type"] == "message":
-      # /^schedule\\.every\\(\\d*\\)\\.[^;\\s\\b]+\\.do$/
-      eval(task["directive"])(task_message, self.bot._guild.get_channel(task["channel"]), task["message"])
+  async def run_task(self, task: dict):
+    async with self._send_limit:
+      if task["type"] == "message":
+        await self.bot._guild.get_channel(task["channel"]).send(task["message"])
 
   #Add to schedule
-  def add_task(self, task: dict):
+  async def add_task(self, task: dict) -> int:
     # Validate task
     jsonschema.validate(instance=task, schema=self._schedule_task_schema)
+    # Raises ValueError for malformed specs, and crons that never fire
+    now = int(time.time())
+    compile_when(task["when"])(now)
     # Submit validated JSON
-    self._schedule.insert(task)
+    doc_id = await self._schedule.insert(task)
     # Set up task immediately
-    self.setup_task(task)
+    self.setup_task(doc_id, task, now)
+    return doc_id
 
   # Schedule commands
   @commands.group(aliases=["sch"])
@@ -54,36 +96,71 @@ class Schedule(Service):
 
   @schedule.command(aliases=["a"])
   async def add(self, ctx: commands.Context, *, data: str):
-    """ Add a task to the schedule. """
+    """ Add a task to the schedule, ie {"type": "message", "channel": 0, "message": "Hi", "when": {"daily": "12:00"}} """
     try:
       # Parse and add task
       data = json.loads(data)
-      self.add_task(data)
+      doc_id = await self.add_task(data)
 
       await react(ctx, "confirm")
-      await ctx.reply(f"Added task of type {fmt_code(data['type'])} to the schedule.", delete_after=10, mention_author=False)
+      await ctx.reply(f"Added task {fmt_code(doc_id)} of type {fmt_code(data['type'])} to the schedule.", delete_after=10, mention_author=False)
 
     except (jsonschema.exceptions.ValidationError, json.decoder.JSONDecodeError) as exc:
       await react(ctx, "deny")
       if exc.__class__ == json.decoder.JSONDecodeError: msg = exc
       else:                                             msg = exc.message
       await ctx.reply(f"JSON Error: {msg}", mention_author=False)
-
-  # @schedule.command(aliases=["r"])
-  # async def remove(self, ctx: commands.Context, id: int):
-  #   """ Remove a task from the schedule. """
-  #   # TODO
-  #   await ctx.reply("Finish this Ada.")
+    except ValueError as exc:
+      await react(ctx, "deny")
+      await ctx.reply(f"Schedule Error: {exc}", mention_author=False)
+
+  @schedule.command(aliases=["r"])
+  async def remove(self, ctx: commands.Context, task_id: int):
+    """ Remove a task from the schedule. """
+    if await self._schedule.remove([task_id]):
+      self._due.discard(task_id)
+      self._next.pop(task_id, None)
+      await react(ctx, "confirm")
+    else:
+      await react(ctx, "deny")
+      await ctx.reply("That's not a task.", delete_after=10, mention_author=False)
 
   @schedule.command(aliases=["l"])
   async def list(self, ctx: commands.Context):
     """ List existing tasks. """
-    await ctx.send(fmt_list(self._schedule.all()))
-
-  # Do stuff every second
-  @tasks.loop(seconds=1)
+    if len(self._schedule) == 0:
+      return await ctx.reply("There are no tasks.", delete_after=10, mention_author=False)
+
+    await ctx.send(fmt_list(
+      f"{fmt_code(str(task.doc_id).rjust(3))} - {task['type']} in <#{task['channel']}>, " +
+      (f"{fmt_when(task['when'])}, next {fmt_code(epoch_str(self._due.when(task.doc_id)))}"
+        if task.doc_id in self._due else "not scheduled")
+      for task in self._schedule.all()
+    ))
+
+  # Sleeps until the next task is due, rather than polling
+  @tasks.loop(seconds=0)
   async def tick(self):
-    schedule.run_pending()
+    await self._due.wait()
+    now = int(time.time())
+    for doc_id in self._due.pop_due(now):
+      task = self._schedule.get(doc_id)
+      if task is None: continue
+      # Fire it, tracked so unloading can cancel it
+      run = create_task(self.run_task(task))
+      self._inflight.add(run)
+      run.add_done_callback(self._task_done)
+      # And line up the next run
+      try:
+        self._due.push(doc_id, self._next[doc_id](now))
+      except Exception as exc:
+        self._next.pop(doc_id, None)
+        self.log.error(f"Couldn't schedule task {doc_id} again, dropping it: {exc}")
+
+  def _task_done(self, run):
+    self._inflight.discard(run)
+    if not run.cancelled() and run.exception() is not None:
+      self.log.error(f"Scheduled task failed: {run.exception()}")
 
   @tick.before_loop
   async def before_tick(self):
@@ -93,3 +170,5 @@ class Schedule(Service):
   def cog_unload(self):
     # Cancel task when unloading the cog
     self.tick.cancel()
+    for run in self._inflight: run.cancel()
+    self._schedule.flush()
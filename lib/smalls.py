@@ -1,17 +1,37 @@
 # External dependencies
+import logging
+
 from discord.ext.commands import Context
 
 # Local dependencies
 from lib.proto import Proto
 from lib.utils.checks import is_bot_ready, is_not_from_bot
-# Services
-from lib.services.core import Core
-from lib.services.music import Music
+from lib.utils.lavalink import lavalink_nodes
 
 class Smalls(Proto):
+  def __init__(self, config: dict):
+    self._lavalink = {}
+    super().__init__(config)
+
+  async def start(self, *args, **kwargs):
+    # Boot Lavalink while the gateway connects, rather than after on_ready.
+    # When clustered, the first cluster runs the local servers for everyone
+    try:
+      self._lavalink = lavalink_nodes(self._config, logging.getLogger(f"{self.__class__.__name__}.Lavalink"),
+        local=self.cluster in (None, 0))
+    except FileNotFoundError as exc:
+      self.log.error(f"{exc.filename} missing, exiting.")
+      exit()
+    for lavalink in self._lavalink.values(): lavalink.start()
+    await super().start(*args, **kwargs)
+
+  async def close(self):
+    await super().close()
+    for lavalink in self._lavalink.values(): lavalink.stop()
+
   async def _do_setup(self):
-    self.add_cog(Core(self))
-    self.add_cog(Music(self))
+    self.load_service("lib.services.core.Core")
+    self.load_service("lib.services.music.Music")
 
   def funnel(self, ctx: Context) -> bool:
     return (
@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+class TTLCache:
+  """
+    Bounded LRU mapping whose entries also expire.
+
+    Every entry gets the default `ttl` (seconds) unless `set` is given its
+    own. Expired entries are dropped lazily when they're looked up or reach
+    the LRU end; past `maxsize` the least recently used entry is evicted.
+    Hits, misses and evictions are counted for `stats`.
+  """
+  def __init__(self, maxsize: int = 1024, ttl: float = 3600, *, clock: Callable[[], float] = time.monotonic):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self._clock = clock
+    self._data = OrderedDict() # type: OrderedDict[Hashable, tuple]
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self) -> int:
+    return len(self._data)
+
+  def __contains__(self, key: Hashable) -> bool:
+    entry = self._data.get(key)
+    return entry is not None and entry[0] > self._clock()
+
+  def get(self, key: Hashable, default: Any = None) -> Any:
+    """ Cached value for `key`, counting a hit or a miss. """
+    entry = self._data.get(key)
+    if entry is not None:
+      if entry[0] > self._clock():
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+      del self._data[key]
+    self.misses += 1
+    return default
+
+  def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+    """ Caches `value` for `ttl` seconds, or the default TTL. """
+    self._data[key] = (self._clock() + (self.ttl if ttl is None else ttl), value)
+    self._data.move_to_end(key)
+    while len(self._data) > self.maxsize:
+      self._data.popitem(last=False)
+      self.evictions += 1
+
+  def pop(self, key: Hashable, default: Any = None) -> Any:
+    entry = self._data.pop(key, _MISSING)
+    return default if entry is _MISSING else entry[1]
+
+  def expire(self) -> int:
+    """ Drops every expired entry, returns how many there were. """
+    now = self._clock()
+    stale = [key for key, (expires, _) in self._data.items() if expires <= now]
+    for key in stale: del self._data[key]
+    return len(stale)
+
+  def clear(self):
+    self._data.clear()
+
+  def stats(self) -> Dict[str, int]:
+    return {
+      "size": len(self._data),
+      "maxsize": self.maxsize,
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions,
+    }
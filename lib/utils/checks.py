@@ -27,6 +27,10 @@ def is_mod(ctx: Context) -> bool:
     set(ctx.bot._config["mod_roles"])
   ) > 0
 
+async def is_operator(ctx: Context) -> bool:
+  """ Checks if the author runs the bot: its owner, or listed in `operators`. """
+  return ctx.author.id in ctx.bot._config.get("operators", []) or await ctx.bot.is_owner(ctx.author)
+
 async def is_guild_member(ctx: Context) -> bool:
-  """ Intended for use in DMs, checks if author is a member of the guild. """
-  return await ctx.bot._guild.fetch_member(ctx.author.id)
+  """ Intended for use in DMs, checks if author is a member of the guild. See lib/utils/members.py. """
+  return await ctx.bot._members.is_member(ctx.author.id)
@@ -0,0 +1,80 @@
+import heapq
+from asyncio import Event, TimeoutError, wait_for
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+class Deadlines:
+  """
+    Min-heap of keyed deadlines.
+
+    Removal is lazy: `discard` only forgets the key, and stale heap entries
+    are skipped (and eventually compacted away) when the head is inspected.
+    `wait` sleeps until the earliest deadline, and wakes early whenever a
+    sooner one is pushed.
+  """
+  def __init__(self, clock: Callable[[], float], *, max_sleep: float = 60):
+    self._clock = clock
+    self._max_sleep = max_sleep
+    self._heap = [] # type: List[Tuple[Any, Hashable]]
+    self._when = {}
+    self._changed = Event()
+
+  def __len__(self) -> int:
+    return len(self._when)
+
+  def __contains__(self, key: Hashable) -> bool:
+    return key in self._when
+
+  def when(self, key: Hashable) -> Optional[Any]:
+    """ When `key` is due, if it's scheduled. """
+    return self._when.get(key)
+
+  def push(self, key: Hashable, when: Any):
+    """ Add or reschedule `key`. """
+    head = self.peek()
+    self._when[key] = when
+    heapq.heappush(self._heap, (when, key))
+    if head is None or when < head[0]:
+      self._changed.set()
+
+  def discard(self, key: Hashable):
+    """ Forget `key`, if present. """
+    if self._when.pop(key, None) is not None:
+      self._compact()
+
+  def peek(self) -> Optional[Tuple[Any, Hashable]]:
+    """ Earliest live (when, key) pair, or None. """
+    while self._heap:
+      when, key = self._heap[0]
+      if self._when.get(key) == when: return when, key
+      heapq.heappop(self._heap)
+    return None
+
+  def pop_due(self, now: Any = None) -> List[Hashable]:
+    """ Remove and return every key due at `now`, earliest first. """
+    if now is None: now = self._clock()
+    due = []
+    while (head := self.peek()) is not None and head[0] <= now:
+      heapq.heappop(self._heap)
+      del self._when[head[1]]
+      due.append(head[1])
+    return due
+
+  async def wait(self):
+    """ Sleep until the earliest deadline is due. """
+    while True:
+      self._changed.clear()
+      head = self.peek()
+      if head is None: timeout = self._max_sleep
+      else:            timeout = min(head[0] - self._clock(), self._max_sleep)
+      if head is not None and timeout <= 0: return
+      try:
+        await wait_for(self._changed.wait(), timeout)
+      except TimeoutError:
+        # Re-check against the clock, in case max_sleep cut the nap short
+        pass
+
+  def _compact(self):
+    # Rebuild once stale entries make up most of the heap
+    if len(self._heap) > 64 and len(self._heap) > 2 * len(self._when):
+      self._heap = [(when, key) for key, when in self._when.items()]
+      heapq.heapify(self._heap)
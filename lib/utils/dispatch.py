@@ -0,0 +1,101 @@
+import asyncio
+import inspect
+import logging
+import time
+from typing import Callable, Container, Dict, List, Optional, Pattern
+
+from discord import Message
+
+class MessageHandler:
+  """
+    An on_message handler and its prefilters. Every filter that's set must
+    pass for the handler to run: the channel and author ids must be `in`
+    their containers (anything with a cheap `__contains__`, which may change
+    over time), the content must start with `prefix` and match `pattern`.
+    Handlers with a pattern are also given the match.
+  """
+  __slots__ = ("func", "name", "channels", "authors", "prefix", "pattern", "seen", "matched", "errors", "busy")
+
+  def __init__(self, func: Callable, *,
+    channels: Optional[Container[int]] = None,
+    authors: Optional[Container[int]] = None,
+    prefix: Optional[str] = None,
+    pattern: Optional[Pattern] = None):
+    self.func = func
+    self.name = getattr(func, "__qualname__", repr(func))
+    self.channels = channels
+    self.authors = authors
+    self.prefix = prefix
+    self.pattern = pattern
+    # Messages considered, passed on, failed, and seconds spent handling them
+    self.seen = 0
+    self.matched = 0
+    self.errors = 0
+    self.busy = 0.0
+
+  def accepts(self, message: Message):
+    """ The handler's arguments if `message` passes every filter, else None. """
+    self.seen += 1
+    if self.channels is not None and message.channel.id not in self.channels: return None
+    if self.authors is not None and message.author.id not in self.authors:    return None
+    if self.prefix is not None and not message.content.startswith(self.prefix): return None
+    if self.pattern is None: return (message,)
+    if (match := self.pattern.match(message.content)) is None: return None
+    return (message, match)
+
+class MessageDispatcher:
+  """
+    Runs registered on_message handlers, in place of one listener each.
+
+    Filters are checked synchronously, so messages a handler doesn't want
+    never cost a coroutine. Plain functions are called inline; coroutine
+    functions are only scheduled once their filters pass.
+  """
+  def __init__(self, log: logging.Logger):
+    self.log = log
+    self.handlers = [] # type: List[MessageHandler]
+
+  def register(self, func: Callable, **filters) -> MessageHandler:
+    handler = MessageHandler(func, **filters)
+    self.handlers.append(handler)
+    return handler
+
+  def unregister(self, handler: MessageHandler):
+    if handler in self.handlers: self.handlers.remove(handler)
+
+  def dispatch(self, message: Message):
+    for handler in self.handlers:
+      if (args := handler.accepts(message)) is None: continue
+      handler.matched += 1
+      start = time.perf_counter()
+      try:
+        result = handler.func(*args)
+      except Exception:
+        handler.errors += 1
+        self.log.exception(f"Message handler {handler.name} failed")
+        continue
+      finally:
+        handler.busy += time.perf_counter() - start
+      if inspect.isawaitable(result):
+        asyncio.ensure_future(self._run(handler, result))
+
+  async def _run(self, handler: MessageHandler, coro):
+    start = time.perf_counter()
+    try:
+      await coro
+    except Exception:
+      handler.errors += 1
+      self.log.exception(f"Message handler {handler.name} failed")
+    finally:
+      handler.busy += time.perf_counter() - start
+
+  def stats(self) -> Dict[str, dict]:
+    return {
+      handler.name: {
+        "seen": handler.seen,
+        "matched": handler.matched,
+        "errors": handler.errors,
+        "busy_ms": round(handler.busy * 1000, 3),
+      }
+      for handler in self.handlers
+    }
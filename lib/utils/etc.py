@@ -1,7 +1,8 @@
 import logging
 from discord.ext.commands import Context, Cog as dCog
 from discord import Emoji, PartialEmoji, Reaction, Guild
-from datetime import timedelta
+from datetime import datetime, timedelta
+import calendar
 from typing import Union
 
 from lib.utils.text import fmt_plur
@@ -49,6 +50,14 @@ def readable_delta(delta: timedelta) -> str:
   if future: return "in " + out
   else:      return out + " ago"
 
+def epoch_str(epoch: int) -> str:
+  """ Formats a UTC epoch using `TIME_FORMAT`. """
+  return datetime.utcfromtimestamp(epoch).strftime(TIME_FORMAT)
+
+def str_epoch(text: str) -> int:
+  """ Parses a `TIME_FORMAT` string, assumed to be in UTC, into an epoch. """
+  return calendar.timegm(datetime.strptime(text, TIME_FORMAT).timetuple())
+
 def time_hms(secs: float) -> str:
   """ Returns a consistent duration. """
   hours = int(secs / 60 / 60)
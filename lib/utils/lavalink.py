@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import os
+import re
+import signal
+import time
+from shlex import split
+from typing import Dict, Optional, Union
+
+import aiohttp
+import yaml
+
+LAVALINK_READY = re.compile(r" lavalink.server.Launcher\s+: Started Launcher")
+RLEVEL = re.compile(r"\s(ERROR|WARN)\s")
+
+# Seconds between REST health checks, and failures in a row before a restart
+HEALTH_INTERVAL = 30
+HEALTH_TIMEOUT = 10
+HEALTH_FAILURES = 3
+# Seconds Lavalink gets to report it started, before it's killed
+STARTUP_TIMEOUT = 120
+# Restart delays double from BACKOFF_BASE up to BACKOFF_MAX, and reset once
+# Lavalink has stayed up for BACKOFF_RESET seconds
+BACKOFF_BASE = 2
+BACKOFF_MAX = 300
+BACKOFF_RESET = 600
+# Seconds to wait for a Lavalink left over from a crashed run to die
+STALE_TIMEOUT = 10
+
+def read_application_yml(path: str) -> dict:
+  """ Lavalink's own config, from the directory it runs in. """
+  with open(os.path.join(path, "application.yml"), "r") as y:
+    return yaml.load(y, Loader=yaml.FullLoader)
+
+class LavalinkProcess:
+  """
+    Runs and supervises a local Lavalink server as an asyncio subprocess.
+
+    Its log is drained in the background into `log`.
+    `launched` is set once the server reports it started and cleared when
+    it exits, `exited` is the reverse. While it runs, its REST port is
+    health-checked; if the process exits, doesn't start in time or stops
+    answering, it's killed and restarted with exponential backoff.
+
+    Its pid is kept in a file next to Lavalink.jar while it runs, so one left
+    behind by a process that crashed (ie. cluster 0, see mycelia.py) is
+    killed before starting another on the same port.
+  """
+  def __init__(self, path: str, args: str, *, port: Optional[int] = None, region: str = "eu_west", log: logging.Logger):
+    self.path = path
+    self.args = args
+    self.region = region
+    self.log = log
+
+    self.config = read_application_yml(path)
+    # Lets several servers share one directory
+    if port is not None:
+      self.config["server"]["port"] = port
+      self.args += f" --server.port={port}"
+
+    self.launched = asyncio.Event()
+    self.exited = asyncio.Event()
+    self.exited.set()
+    self.restarts = 0
+    self._process = None # type: Optional[asyncio.subprocess.Process]
+    self._task = None # type: Optional[asyncio.Task]
+
+  @property
+  def host(self) -> str:
+    return self.config["server"]["address"]
+
+  @property
+  def port(self) -> int:
+    return self.config["server"]["port"]
+
+  @property
+  def rest_uri(self) -> str:
+    return f"http://{self.host}:{self.port}"
+
+  @property
+  def password(self) -> str:
+    return self.config["lavalink"]["server"]["password"]
+
+  @property
+  def pid_path(self) -> str:
+    return os.path.join(self.path, f"lavalink.{self.port}.pid")
+
+  @property
+  def running(self) -> bool:
+    return self._process is not None and self._process.returncode is None
+
+  def start(self):
+    """ Starts supervising, in the background. """
+    if self._task is None: self._task = asyncio.get_event_loop().create_task(self.supervise())
+
+  def stop(self):
+    """ Stops supervising, and terminates Lavalink. """
+    if self._task is not None: self._task.cancel()
+    self._task = None
+    if self.running: self._process.terminate()
+
+  async def supervise(self):
+    failures = 0
+    try:
+      while True:
+        started = time.monotonic()
+        try:
+          await self._run()
+          self.log.warning(f"Lavalink exited with code {self._process.returncode}.")
+        except OSError as exc:
+          self.log.error(f"Couldn't start Lavalink: {exc}")
+
+        if time.monotonic() - started > BACKOFF_RESET: failures = 0
+        delay = min(BACKOFF_BASE * 2 ** failures, BACKOFF_MAX)
+        failures += 1
+        self.restarts += 1
+        self.log.info(f"Restarting Lavalink in {delay}s.")
+        await asyncio.sleep(delay)
+    finally:
+      if self.running: self._process.terminate()
+
+  async def _run(self):
+    """ Runs Lavalink once, until it exits or is killed for failing health checks. """
+    await self._kill_stale()
+    self._process = await asyncio.create_subprocess_exec(
+      *split(f"java -jar ./Lavalink.jar {self.args}"),
+      cwd=self.path,
+      stdout=asyncio.subprocess.PIPE,
+      stderr=asyncio.subprocess.STDOUT)
+    self.exited.clear()
+    self.log.info(f"Started Lavalink (pid {self._process.pid}).")
+    with open(self.pid_path, "w") as f: f.write(str(self._process.pid))
+
+    drain = asyncio.ensure_future(self._drain())
+    health = asyncio.ensure_future(self._health())
+    try:
+      await self._process.wait()
+    finally:
+      health.cancel()
+      # Only still running if we're being cancelled
+      if self.running: self._process.terminate()
+      # Anything it left running could hold its output open
+      try: await asyncio.wait_for(drain, 5)
+      except asyncio.TimeoutError: pass
+      self.launched.clear()
+      self.exited.set()
+      try: os.remove(self.pid_path)
+      except OSError: pass
+
+  async def _kill_stale(self):
+    """ Kills the Lavalink in our pid file, if it's still around. """
+    try:
+      with open(self.pid_path, "r") as f: pid = int(f.read())
+      # Pids get reused, so make sure it's actually Lavalink
+      with open(f"/proc/{pid}/cmdline", "rb") as f: cmdline = f.read()
+    except (OSError, ValueError):
+      return
+    if b"Lavalink.jar" not in cmdline: return
+
+    self.log.warning(f"Killing Lavalink left over from a previous run (pid {pid}).")
+    try:
+      os.kill(pid, signal.SIGKILL)
+      deadline = time.monotonic() + STALE_TIMEOUT
+      while time.monotonic() < deadline:
+        os.kill(pid, 0)
+        await asyncio.sleep(0.1)
+      self.log.error(f"Lavalink (pid {pid}) is still around.")
+    except ProcessLookupError:
+      pass
+
+  async def _drain(self):
+    """ Forwards Lavalink's log, watching for the startup line. """
+    while line := await self._process.stdout.readline():
+      line = line.decode("utf-8", "replace").rstrip()
+      if LAVALINK_READY.search(line):
+        self.log.info("Lavalink is ready.")
+        self.launched.set()
+      if match := RLEVEL.search(line):
+        self.log.log(logging.ERROR if match[1] == "ERROR" else logging.WARNING, line)
+      else:
+        self.log.debug(line)
+
+  async def _health(self):
+    """ Kills Lavalink if it doesn't start in time, or once its REST port stops answering. """
+    try:
+      await asyncio.wait_for(self.launched.wait(), STARTUP_TIMEOUT)
+    except asyncio.TimeoutError:
+      self.log.error(f"Lavalink didn't start within {STARTUP_TIMEOUT}s, killing it.")
+      self._process.kill()
+      return
+    failures = 0
+    timeout = aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+      while failures < HEALTH_FAILURES:
+        await asyncio.sleep(HEALTH_INTERVAL)
+        try:
+          async with session.get(f"{self.rest_uri}/version", headers={ "Authorization": self.password }) as resp:
+            # Older servers 404 here, which is still an answer
+            healthy = resp.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+          healthy = False
+        failures = 0 if healthy else failures + 1
+        if not healthy: self.log.warning(f"Lavalink health check failed ({failures}/{HEALTH_FAILURES}).")
+    self.log.error("Lavalink stopped responding, killing it.")
+    self._process.kill()
+
+class LavalinkRemote:
+  """
+    A Lavalink server someone else runs, ie on another machine. Quacks like
+    a `LavalinkProcess` that never exits.
+  """
+  def __init__(self, host: str, port: int, password: str, *, region: str = "eu_west"):
+    self.host = host
+    self.port = port
+    self.password = password
+    self.region = region
+    self.restarts = 0
+
+    self.launched = asyncio.Event()
+    self.launched.set()
+    self.exited = asyncio.Event()
+
+  @property
+  def rest_uri(self) -> str:
+    return f"http://{self.host}:{self.port}"
+
+  @property
+  def running(self) -> bool:
+    return True
+
+  def start(self):
+    pass
+
+  def stop(self):
+    pass
+
+def lavalink_nodes(config: dict, log: logging.Logger, *, local: bool = True) -> Dict[str, Union[LavalinkProcess, LavalinkRemote]]:
+  """
+    Lavalink servers from a bot's config, by name: `lavalink_nodes`, or just
+    `lavalink_path` if that's missing. Nodes with a `path` are run locally,
+    unless `local` is false, in which case they're left to another process
+    and just connected to.
+  """
+  specs = config.get("lavalink_nodes") or [
+    { "name": "local", "path": config["lavalink_path"], "args": config.get("lavalink_args", "") }
+  ]
+  nodes = {}
+  for spec in specs:
+    region = spec.get("region", "eu_west")
+    if "path" in spec and local:
+      nodes[spec["name"]] = LavalinkProcess(spec["path"], spec.get("args", ""),
+        port=spec.get("port"), region=region, log=log.getChild(spec["name"]))
+    elif "path" in spec:
+      app = read_application_yml(spec["path"])
+      nodes[spec["name"]] = LavalinkRemote(app["server"]["address"], spec.get("port", app["server"]["port"]),
+        app["lavalink"]["server"]["password"], region=region)
+    else:
+      nodes[spec["name"]] = LavalinkRemote(spec["host"], spec["port"], spec["password"], region=region)
+  return nodes
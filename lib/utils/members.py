@@ -0,0 +1,89 @@
+import logging
+from typing import Dict, Optional
+
+from discord import Guild, Member, MemberCacheFlags, Message, NotFound
+
+from lib.utils.cache import TTLCache
+
+# Seconds a member is kept for once seen or fetched; joins and leaves
+# invalidate them sooner
+MEMBER_CACHE_TTL = 300
+MEMBER_CACHE_SIZE = 1000
+
+def member_cache_options(policy: str) -> dict:
+  """
+    Client options for a `member_cache` policy. "full" chunks and caches
+    every member at startup; "recent" does neither, leaving `GuildMembers`
+    to keep those who've spoken lately and fetch the rest when asked.
+  """
+  if policy == "full":   return {}
+  if policy == "recent": return { "chunk_guilds_at_startup": False, "member_cache_flags": MemberCacheFlags.none() }
+  raise ValueError(f"Unknown member_cache policy: {policy}")
+
+class GuildMembers:
+  """
+    Guild members by id, for checks that need them outside the guild (ie.
+    in DMs), without a REST call where it can.
+
+    The gateway member cache is asked first, and is authoritative once the
+    guild is chunked. Otherwise members are kept in an LRU of `maxsize`,
+    filled by `saw_message` (see lib/biggs.py) and by REST fetches, whose
+    answers (either way) expire after `ttl` seconds, and are dropped when
+    the user joins or leaves. Without a member cache, discord.py doesn't
+    dispatch on_member_remove, so leaves are then taken from the raw event
+    by `socket_response`. How each answer was found is counted for
+    `stats`.
+  """
+  def __init__(self, guild: Guild, log: logging.Logger, *, ttl: float = MEMBER_CACHE_TTL, maxsize: int = MEMBER_CACHE_SIZE):
+    self.guild = guild
+    self.log = log
+    # Members, or False for users known not to be one
+    self._cache = TTLCache(maxsize, ttl)
+    self.gateway = 0
+    self.cached = 0
+    self.rest = 0
+
+  async def get(self, user_id: int) -> Optional[Member]:
+    if (member := self.guild.get_member(user_id)) is not None:
+      self.gateway += 1
+      return member
+    if self.guild.chunked:
+      self.gateway += 1
+      return None
+    if (member := self._cache.get(user_id)) is not None:
+      self.cached += 1
+      return member or None
+
+    self.rest += 1
+    try:
+      member = await self.guild.fetch_member(user_id)
+    except NotFound:
+      member = False
+    self._cache.set(user_id, member)
+    self.log.debug(f"Fetched membership of user {user_id}: {bool(member)}")
+    return member or None
+
+  async def is_member(self, user_id: int) -> bool:
+    return await self.get(user_id) is not None
+
+  def saw_message(self, message: Message):
+    """ Keeps the authors of guild messages, who are likely to be asked about. """
+    if message.guild is not None and message.guild.id == self.guild.id and isinstance(message.author, Member):
+      self._cache.set(message.author.id, message.author)
+
+  def forget(self, user_id: int):
+    self._cache.pop(user_id)
+
+  # Listeners, see lib/biggs.py
+  async def member_joined(self, member: Member):
+    if member.guild.id == self.guild.id: self.forget(member.id)
+
+  async def member_left(self, member: Member):
+    if member.guild.id == self.guild.id: self.forget(member.id)
+
+  async def socket_response(self, msg: dict):
+    if msg.get("t") == "GUILD_MEMBER_REMOVE" and int(msg["d"]["guild_id"]) == self.guild.id:
+      self.forget(int(msg["d"]["user"]["id"]))
+
+  def stats(self) -> Dict[str, int]:
+    return { "gateway": self.gateway, "cached": self.cached, "rest": self.rest, **self._cache.stats() }
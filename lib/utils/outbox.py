@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import discord
+
+from lib.utils.cache import TTLCache
+from lib.utils.text import MESSAGE_LIMIT
+
+# Discord allows 5 messages per 5 seconds per channel; edits have their own
+# bucket with the same limits
+BUCKET_RATE = 5
+BUCKET_PER = 5.0
+# Seconds confirmations wait for company before going out together
+COALESCE_WINDOW = 0.5
+
+class Bucket:
+  """ Token bucket, `rate` calls per `per` seconds. """
+  __slots__ = ("rate", "per", "tokens", "updated")
+
+  def __init__(self, rate: int, per: float):
+    self.rate = rate
+    self.per = per
+    self.tokens = float(rate)
+    self.updated = time.monotonic()
+
+  async def acquire(self):
+    while True:
+      now = time.monotonic()
+      self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+      self.updated = now
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return
+      await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+class Outbox:
+  """
+    Outbound messages for the services.
+
+    Sends and edits wait on a token bucket per route and channel, so bursts
+    queue up here instead of running into 429s. `notify` coalesces
+    confirmations per channel into one message; `sticky` keeps one message
+    per key and edits it, keeping only the latest content.
+  """
+  def __init__(self, log: logging.Logger, *, rate: int = BUCKET_RATE, per: float = BUCKET_PER, window: float = COALESCE_WINDOW):
+    self.log = log
+    self.rate = rate
+    self.per = per
+    self.window = window
+    # Buckets left alone for `per` seconds are full again, so can be dropped
+    self._buckets = TTLCache(4096, per)
+    self._pending = {} # type: Dict[Tuple[int, Optional[float]], List[str]]
+    self._sticky = {} # type: Dict[Hashable, discord.Message]
+    self._sticky_latest = {} # type: Dict[Hashable, Tuple[discord.abc.Messageable, str]]
+    self._sticky_busy = set()
+    # API calls made, and calls saved by coalescing or skipping stale edits
+    self.calls = 0
+    self.saved = 0
+
+  async def _acquire(self, route: str, channel_id: int):
+    key = (route, channel_id)
+    if (bucket := self._buckets.get(key)) is None: bucket = Bucket(self.rate, self.per)
+    self._buckets.set(key, bucket)
+    await bucket.acquire()
+    self.calls += 1
+
+  async def send(self, channel: discord.abc.Messageable, content: str, **kwargs) -> discord.Message:
+    """ `channel.send`, once the channel's bucket allows it. """
+    await self._acquire("send", channel.id)
+    return await channel.send(content, **kwargs)
+
+  async def edit(self, message: discord.Message, content: str):
+    """ `message.edit`, once the channel's bucket allows it. """
+    await self._acquire("edit", message.channel.id)
+    await message.edit(content=content)
+
+  def notify(self, channel: discord.abc.Messageable, content: str, *, delete_after: Optional[float] = 10):
+    """ Queues a confirmation; those sent in quick succession go out as one message. """
+    key = (channel.id, delete_after)
+    if (pending := self._pending.get(key)) is not None:
+      pending.append(content)
+      self.saved += 1
+      return
+    self._pending[key] = [content]
+    asyncio.ensure_future(self._flush(channel, key))
+
+  async def _flush(self, channel: discord.abc.Messageable, key: Tuple[int, Optional[float]]):
+    await asyncio.sleep(self.window)
+    lines = self._pending.pop(key)
+    # Pack lines into as few messages as fit
+    batches = [lines[0]]
+    for line in lines[1:]:
+      if len(batches[-1]) + 1 + len(line) > MESSAGE_LIMIT: batches.append(line)
+      else:                                                batches[-1] += "\n" + line
+    for batch in batches:
+      # Nobody awaits this, so whatever goes wrong ends here
+      try: await self.send(channel, batch[:MESSAGE_LIMIT], delete_after=key[1])
+      except discord.HTTPException as exc: self.log.warning(f"Couldn't send to channel {channel.id}: {exc}")
+      except Exception:                    self.log.exception(f"Couldn't send to channel {channel.id}")
+
+  async def sticky(self, key: Hashable, channel: discord.abc.Messageable, content: str):
+    """
+      Shows `content` in the message kept for `key`, editing it in place.
+      Sends a new one if there's none yet, it's gone, or it's in another
+      channel. Updates made while one is waiting on the bucket replace it.
+    """
+    self._sticky_latest[key] = (channel, content)
+    if key in self._sticky_busy:
+      self.saved += 1
+      return
+
+    self._sticky_busy.add(key)
+    try:
+      while key in self._sticky_latest:
+        channel, content = self._sticky_latest.pop(key)
+        message = self._sticky.get(key)
+        edit = message is not None and message.channel.id == channel.id
+        await self._acquire("edit" if edit else "send", channel.id)
+        # Only the newest content is worth the call, if it's for the same channel
+        if (newer := self._sticky_latest.get(key)) is not None and newer[0].id == channel.id:
+          channel, content = self._sticky_latest.pop(key)
+        if edit:
+          try:
+            await message.edit(content=content)
+            continue
+          except discord.NotFound:
+            await self._acquire("send", channel.id)
+        self._sticky[key] = await channel.send(content)
+    except discord.HTTPException as exc:
+      self._sticky_latest.pop(key, None)
+      self.log.warning(f"Couldn't update message for {key}: {exc}")
+    finally:
+      self._sticky_busy.discard(key)
+
+  def forget(self, key: Hashable):
+    """ Stops tracking `key`'s message, the next `sticky` sends a new one. """
+    self._sticky.pop(key, None)
+
+  def stats(self) -> Dict[str, int]:
+    return { "calls": self.calls, "saved": self.saved, "buckets": len(self._buckets) }
@@ -0,0 +1,179 @@
+import random
+from asyncio import Event
+from typing import Callable, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+class _Node:
+  __slots__ = ("item", "weight", "priority", "size", "total", "left", "right")
+
+  def __init__(self, item, weight: int):
+    self.item = item
+    self.weight = weight
+    self.priority = random.random()
+    self.size = 1
+    self.total = weight
+    self.left = None # type: Optional[_Node]
+    self.right = None # type: Optional[_Node]
+
+  def update(self):
+    self.size = 1
+    self.total = self.weight
+    if self.left is not None:
+      self.size += self.left.size
+      self.total += self.left.total
+    if self.right is not None:
+      self.size += self.right.size
+      self.total += self.right.total
+
+def _size(node: Optional[_Node]) -> int:
+  return node.size if node is not None else 0
+
+def _split(node: Optional[_Node], k: int) -> Tuple[Optional[_Node], Optional[_Node]]:
+  """ Splits into the first `k` items and the rest. """
+  if node is None: return None, None
+  if _size(node.left) >= k:
+    left, node.left = _split(node.left, k)
+    node.update()
+    return left, node
+  node.right, right = _split(node.right, k - _size(node.left) - 1)
+  node.update()
+  return node, right
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+  if left is None: return right
+  if right is None: return left
+  if left.priority > right.priority:
+    left.right = _merge(left.right, right)
+    left.update()
+    return left
+  right.left = _merge(left, right.left)
+  right.update()
+  return right
+
+def _build(nodes: List[_Node]) -> Optional[_Node]:
+  """ Treap of `nodes` in order, in O(n). """
+  stack = [] # type: List[_Node]
+  for node in nodes:
+    last = None
+    while stack and stack[-1].priority < node.priority:
+      last = stack.pop()
+      last.update()
+    node.left = last
+    if stack: stack[-1].right = node
+    stack.append(node)
+  while len(stack) > 1: stack.pop().update()
+  if stack: stack[0].update()
+  return stack[0] if stack else None
+
+def _walk(node: Optional[_Node]) -> Iterator[_Node]:
+  stack = []
+  while stack or node is not None:
+    while node is not None:
+      stack.append(node)
+      node = node.left
+    node = stack.pop()
+    yield node
+    node = node.right
+
+class Playlist(Generic[T]):
+  """
+    Indexed queue, as an implicit treap.
+
+    Indexed access, insertion, removal, range removal, moves and slices all
+    cost O(log n) (plus the length of the slice). The summed weight of all
+    items, ie the remaining duration, is kept up to date as it changes.
+    `get` waits for an item like `asyncio.Queue.get`.
+  """
+  def __init__(self, weight: Callable[[T], int] = lambda item: 0, items: Iterable[T] = ()):
+    self._weight = weight
+    self._root = None # type: Optional[_Node]
+    self._nonempty = Event()
+    self.extend(items)
+
+  def __len__(self) -> int:
+    return _size(self._root)
+
+  def __bool__(self) -> bool:
+    return self._root is not None
+
+  def __iter__(self) -> Iterator[T]:
+    return (node.item for node in _walk(self._root))
+
+  def __getitem__(self, index: int) -> T:
+    node = self._root
+    index = self._index(index)
+    while node is not None:
+      left = _size(node.left)
+      if index < left:    node = node.left
+      elif index == left: return node.item
+      else:
+        index -= left + 1
+        node = node.right
+    raise IndexError("playlist index out of range")
+
+  @property
+  def total(self) -> int:
+    """ Summed weight of every item. """
+    return self._root.total if self._root is not None else 0
+
+  def _index(self, index: int) -> int:
+    if index < 0: index += len(self)
+    if not 0 <= index < len(self): raise IndexError("playlist index out of range")
+    return index
+
+  def _changed(self):
+    if self._root is None: self._nonempty.clear()
+    else:                  self._nonempty.set()
+
+  def append(self, item: T):
+    self._root = _merge(self._root, _Node(item, self._weight(item)))
+    self._changed()
+
+  def extend(self, items: Iterable[T]):
+    """ Appends every item in one go. """
+    self._root = _merge(self._root, _build([_Node(item, self._weight(item)) for item in items]))
+    self._changed()
+
+  def insert(self, index: int, item: T):
+    left, right = _split(self._root, max(0, min(index, len(self))))
+    self._root = _merge(_merge(left, _Node(item, self._weight(item))), right)
+    self._changed()
+
+  def pop(self, index: int = 0) -> T:
+    index = self._index(index)
+    left, rest = _split(self._root, index)
+    node, right = _split(rest, 1)
+    self._root = _merge(left, right)
+    self._changed()
+    return node.item
+
+  def remove_range(self, start: int, stop: int) -> List[T]:
+    """ Removes and returns the items in [start, stop). """
+    left, rest = _split(self._root, max(0, start))
+    middle, right = _split(rest, max(0, stop - max(0, start)))
+    self._root = _merge(left, right)
+    self._changed()
+    return [node.item for node in _walk(middle)]
+
+  def move(self, src: int, dst: int):
+    """ Moves the item at `src` so it ends up at `dst`. """
+    self.insert(dst, self.pop(src))
+
+  def slice(self, start: int, stop: int) -> List[T]:
+    """ Items in [start, stop), without removing them. """
+    left, rest = _split(self._root, max(0, start))
+    middle, right = _split(rest, max(0, stop - max(0, start)))
+    items = [node.item for node in _walk(middle)]
+    self._root = _merge(_merge(left, middle), right)
+    return items
+
+  def clear(self):
+    self._root = None
+    self._changed()
+
+  async def get(self) -> T:
+    """ Removes and returns the first item, waiting for one if needed. """
+    while self._root is None:
+      await self._nonempty.wait()
+    return self.pop(0)
@@ -0,0 +1,210 @@
+import json
+import re
+import sqlite3
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Union
+
+from tinydb.queries import QueryInstance
+from tinydb.table import Document
+
+if TYPE_CHECKING:
+  from tinydb import TinyDB
+
+# Fields worth a real index, per table
+INDEXES = {
+  "roles":     ["id"],
+  "reminders": ["datetime", "channel", "meta.member"],
+  "schedule":  ["channel"],
+}
+
+RFIELD = re.compile(r"^\w+$")
+
+def json_path(path: Iterable[str]) -> str:
+  """
+    SQLite JSON path for a TinyDB query path. It's inlined into the SQL, so
+    that expression indexes apply, hence the strict field names.
+  """
+  path = list(path)
+  if not all(isinstance(part, str) and RFIELD.match(part) for part in path):
+    raise ValueError(f"Unsupported field path: {path}")
+  return "$" + "".join(f".{part}" for part in path)
+
+class SQLiteTable:
+  """
+    One table of a `SQLiteDB`, with the parts of `tinydb.table.Table`'s API
+    that the services use. Documents are stored as JSON, and simple equality
+    queries (ie `where("id") == 1`) run in SQL, against an index when the
+    field has one.
+  """
+  def __init__(self, db: "SQLiteDB", name: str):
+    self._db = db
+    self._name = name
+    with db._conn:
+      db._conn.execute(
+        f'CREATE TABLE IF NOT EXISTS "{name}" (doc_id INTEGER PRIMARY KEY AUTOINCREMENT, doc TEXT NOT NULL)')
+      for field in INDEXES.get(name, []):
+        db._conn.execute(
+          f'CREATE INDEX IF NOT EXISTS "{name}.{field}" ON "{name}" '
+          f"(json_extract(doc, '{json_path(field.split('.'))}'))")
+
+  def __repr__(self):
+    return f"<{self.__class__.__name__} name={self._name!r}, total={len(self)}>"
+
+  @property
+  def name(self) -> str:
+    return self._name
+
+  def __len__(self) -> int:
+    return self._db._conn.execute(f'SELECT COUNT(*) FROM "{self._name}"').fetchone()[0]
+
+  def __iter__(self) -> Iterator[Document]:
+    return iter(self.all())
+
+  def _select(self, where: str = "", params: tuple = ()) -> List[Document]:
+    rows = self._db._conn.execute(f'SELECT doc_id, doc FROM "{self._name}" {where} ORDER BY doc_id', params)
+    return [Document(json.loads(doc), doc_id) for doc_id, doc in rows]
+
+  def _matching(self, cond: QueryInstance) -> List[Document]:
+    # Equality on a plain path runs in SQL, anything fancier in Python
+    _hash = getattr(cond, "_hash", None)
+    if (_hash and _hash[0] == "==" and isinstance(_hash[2], (int, str, float))
+        and not isinstance(_hash[2], bool)):
+      try:
+        return self._select(f"WHERE json_extract(doc, '{json_path(_hash[1])}') = ?", (_hash[2],))
+      except ValueError: pass
+    return [doc for doc in self._select() if cond(doc)]
+
+  def all(self) -> List[Document]:
+    return self._select()
+
+  def search(self, cond: QueryInstance) -> List[Document]:
+    return self._matching(cond)
+
+  def get(self, cond: Optional[QueryInstance] = None, doc_id: Optional[int] = None) -> Optional[Document]:
+    if doc_id is not None:
+      docs = self._select("WHERE doc_id = ?", (doc_id,))
+    elif cond is not None:
+      docs = self._matching(cond)
+    else:
+      raise RuntimeError("You have to pass either cond or doc_id")
+    return docs[0] if docs else None
+
+  def contains(self, cond: Optional[QueryInstance] = None, doc_id: Optional[int] = None) -> bool:
+    return self.get(cond, doc_id) is not None
+
+  def insert(self, document: Mapping) -> int:
+    return self.insert_multiple([document])[0]
+
+  def insert_multiple(self, documents: Iterable[Mapping]) -> List[int]:
+    doc_ids = []
+    with self._db._conn as conn:
+      for document in documents:
+        if not isinstance(document, Mapping):
+          raise ValueError("Document is not a Mapping")
+        # Keep the ids of imported TinyDB documents
+        if isinstance(document, Document):
+          cursor = conn.execute(f'INSERT INTO "{self._name}" (doc_id, doc) VALUES (?, ?)',
+            (document.doc_id, json.dumps(document)))
+        else:
+          cursor = conn.execute(f'INSERT INTO "{self._name}" (doc) VALUES (?)', (json.dumps(document),))
+        doc_ids.append(cursor.lastrowid)
+    return doc_ids
+
+  def update(
+    self,
+    fields: Union[Mapping, Callable[[dict], None]],
+    cond: Optional[QueryInstance] = None,
+    doc_ids: Optional[Iterable[int]] = None,
+  ) -> List[int]:
+    if doc_ids is not None:
+      doc_ids = set(doc_ids)
+      docs = [doc for doc in self._select() if doc.doc_id in doc_ids]
+    elif cond is not None:
+      docs = self._matching(cond)
+    else:
+      docs = self._select()
+
+    with self._db._conn as conn:
+      for doc in docs:
+        if callable(fields): fields(doc)
+        else:                doc.update(fields)
+        conn.execute(f'UPDATE "{self._name}" SET doc = ? WHERE doc_id = ?', (json.dumps(doc), doc.doc_id))
+    return [doc.doc_id for doc in docs]
+
+  def remove(self, cond: Optional[QueryInstance] = None, doc_ids: Optional[Iterable[int]] = None) -> List[int]:
+    if doc_ids is not None:
+      removed = list(doc_ids)
+    elif cond is not None:
+      removed = [doc.doc_id for doc in self._matching(cond)]
+    else:
+      raise RuntimeError("Use truncate() to remove all documents")
+
+    with self._db._conn as conn:
+      conn.executemany(f'DELETE FROM "{self._name}" WHERE doc_id = ?', [(doc_id,) for doc_id in removed])
+    return removed
+
+  def write_batch(self, upserts: Mapping[int, Mapping], removes: Iterable[int]):
+    """ Writes and removes documents by id, in one transaction. """
+    with self._db._conn as conn:
+      conn.executemany(f'INSERT OR REPLACE INTO "{self._name}" (doc_id, doc) VALUES (?, ?)',
+        [(doc_id, json.dumps(doc)) for doc_id, doc in upserts.items()])
+      conn.executemany(f'DELETE FROM "{self._name}" WHERE doc_id = ?', [(doc_id,) for doc_id in removes])
+
+  def truncate(self):
+    with self._db._conn as conn:
+      conn.execute(f'DELETE FROM "{self._name}"')
+
+class SQLiteDB:
+  """
+    Drop-in replacement for `TinyDB`, backed by SQLite in WAL mode, so a
+    write costs O(row) rather than a rewrite of the whole JSON file.
+  """
+  def __init__(self, path: str):
+    self._path = path
+    # Written to from the storage worker thread, see lib.utils.storage
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute("PRAGMA synchronous=NORMAL")
+    self._tables = {} # type: Dict[str, SQLiteTable]
+
+  def __repr__(self):
+    return f"<{self.__class__.__name__} path={self._path!r}>"
+
+  def table(self, name: str) -> SQLiteTable:
+    if name not in self._tables:
+      self._tables[name] = SQLiteTable(self, name)
+    return self._tables[name]
+
+  def tables(self) -> set:
+    rows = self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_sequence'")
+    return { name for name, in rows }
+
+  def is_empty(self) -> bool:
+    return all(len(self.table(name)) == 0 for name in self.tables())
+
+  def import_json(self, path: str) -> Dict[str, int]:
+    """
+      Copies every table of a TinyDB JSON file into this database, keeping
+      doc ids. Returns the number of documents imported per table.
+    """
+    with open(path, "r") as f:
+      data = json.load(f)
+    imported = {}
+    for name, docs in data.items():
+      imported[name] = len(self.table(name).insert_multiple(
+        Document(doc, int(doc_id)) for doc_id, doc in docs.items()))
+    return imported
+
+  def close(self):
+    self._conn.close()
+
+def open_db(engine: str, path: str) -> Union["TinyDB", SQLiteDB]:
+  """
+    Opens the database at `path` (without an extension) with the given
+    storage engine, either "tinydb" or "sqlite".
+  """
+  if engine == "tinydb":
+    from tinydb import TinyDB
+    return TinyDB(f"{path}.json")
+  if engine == "sqlite":
+    return SQLiteDB(f"{path}.sqlite3")
+  raise ValueError(f"Unknown storage engine: {engine}")
@@ -0,0 +1,31 @@
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+class StartupProfile:
+  """
+    Timings of startup phases, and moments, relative to when this module
+    was first imported. Only printed with `mycelia.py run --profile-startup`.
+  """
+  def __init__(self):
+    self.origin = time.perf_counter()
+    self.enabled = False
+    # Name, seconds since origin, and seconds taken (0 for moments)
+    self.phases = [] # type: List[Tuple[str, float, float]]
+
+  @contextmanager
+  def phase(self, name: str):
+    start = time.perf_counter()
+    try:     yield
+    finally: self.phases.append((name, start - self.origin, time.perf_counter() - start))
+
+  def mark(self, name: str):
+    self.phases.append((name, time.perf_counter() - self.origin, 0.0))
+
+  def report(self) -> str:
+    lines = [f"{'at':>9} {'took':>10}  phase"]
+    for name, at, took in self.phases:
+      lines.append(f"{at:8.3f}s {took * 1000:8.1f}ms  {name}" if took else f"{at:8.3f}s {'':>10}  {name}")
+    return "\n".join(lines)
+
+profile = StartupProfile()
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, Union
+
+from tinydb.queries import QueryInstance
+from tinydb.table import Document
+
+log = logging.getLogger("Biggs.Storage")
+
+class AsyncTable:
+  """
+    In-memory mirror of one database table, with secondary indexes.
+
+    Reads are served from memory. Writes update the mirror right away, and
+    are handed to the `Storage` to be written behind in batches, so the
+    event loop never waits on the disk.
+
+    Every keyword argument names an index and gives the function that
+    extracts its key from a row, so lookups cost O(k) for k matching rows.
+  """
+  def __init__(self, storage: "Storage", name: str, **indexes: Callable[[dict], Hashable]):
+    self._storage = storage
+    self._name = name
+    self._keyfuncs = indexes
+    self._docs = {} # type: Dict[int, Document]
+    self._indexes = { name: defaultdict(set) for name in indexes } # type: Dict[str, Dict[Hashable, Set[int]]]
+
+    for doc in storage._db.table(name).all(): self._add(doc)
+    # Never reuse an id, even one removed before being written
+    self._next_id = max(self._docs, default=0) + 1
+
+  def __len__(self) -> int:
+    return len(self._docs)
+
+  def __iter__(self) -> Iterator[Document]:
+    return iter(list(self._docs.values()))
+
+  @property
+  def name(self) -> str:
+    return self._name
+
+  # Reads
+  def all(self) -> List[Document]:
+    return list(self._docs.values())
+
+  def get(self, doc_id: int) -> Optional[Document]:
+    return self._docs.get(doc_id)
+
+  def search(self, cond: QueryInstance) -> List[Document]:
+    return [doc for doc in self._docs.values() if cond(doc)]
+
+  def lookup(self, index: str, key: Hashable) -> List[Document]:
+    """ All rows whose `index` key equals `key`. """
+    return [self._docs[doc_id] for doc_id in self._indexes[index].get(key, ())]
+
+  def ids(self, index: str, key: Hashable) -> List[int]:
+    """ Like `lookup`, but only the doc ids. """
+    return list(self._indexes[index].get(key, ()))
+
+  # Writes
+  async def insert(self, document: Mapping) -> int:
+    doc_id = self._next_id
+    self._next_id += 1
+    self._add(Document(document, doc_id))
+    await self._storage._written(self._name, doc_id, dict(document))
+    return doc_id
+
+  async def update(self, fields: Union[Mapping, Callable[[dict], None]], doc_ids: Iterable[int]) -> List[int]:
+    doc_ids = [doc_id for doc_id in doc_ids if doc_id in self._docs]
+    for doc_id in doc_ids:
+      doc = Document(self._drop(doc_id), doc_id)
+      if callable(fields): fields(doc)
+      else:                doc.update(fields)
+      self._add(doc)
+      await self._storage._written(self._name, doc_id, dict(doc))
+    return doc_ids
+
+  async def remove(self, doc_ids: Iterable[int]) -> List[int]:
+    doc_ids = [doc_id for doc_id in doc_ids if doc_id in self._docs]
+    for doc_id in doc_ids:
+      self._drop(doc_id)
+      await self._storage._written(self._name, doc_id, None)
+    return doc_ids
+
+  def flush(self):
+    """ Synchronously write everything pending, ie in `cog_unload`. """
+    self._storage.flush_sync()
+
+  def _add(self, doc: Document):
+    self._docs[doc.doc_id] = doc
+    for name, keyfunc in self._keyfuncs.items():
+      self._indexes[name][keyfunc(doc)].add(doc.doc_id)
+
+  def _drop(self, doc_id: int) -> Document:
+    doc = self._docs.pop(doc_id)
+    for name, keyfunc in self._keyfuncs.items():
+      key = keyfunc(doc)
+      bucket = self._indexes[name][key]
+      bucket.discard(doc_id)
+      if not bucket: del self._indexes[name][key]
+    return doc
+
+class Storage:
+  """
+    Async facade over a `TinyDB` or `SQLiteDB`.
+
+    Pending writes are coalesced per document (the last write wins) and
+    flushed on a worker thread every `interval` seconds, or as soon as
+    `batch` documents are dirty. Call `close` on shutdown for a final flush.
+  """
+  def __init__(self, db, *, interval: float = 1, batch: int = 100):
+    self._db = db
+    self._interval = interval
+    self._batch = batch
+    self._tables = {} # type: Dict[str, AsyncTable]
+    # table -> doc_id -> document, or None when removed
+    self._pending = defaultdict(dict) # type: Dict[str, Dict[int, Optional[dict]]]
+    self._full = asyncio.Event()
+    self._lock = threading.Lock()
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+    # The batch being written on the worker thread, if any
+    self._inflight = None # type: Optional[Tuple[Future, Dict[str, Dict[int, Optional[dict]]]]]
+    self._flusher = asyncio.ensure_future(self._flush_loop())
+
+  def table(self, name: str, **indexes: Callable[[dict], Hashable]) -> AsyncTable:
+    """ Mirror of the table `name`, loaded on first use. """
+    if name not in self._tables:
+      self._tables[name] = AsyncTable(self, name, **indexes)
+    return self._tables[name]
+
+  @property
+  def pending(self) -> int:
+    return sum(map(len, self._pending.values()))
+
+  async def _written(self, table: str, doc_id: int, document: Optional[dict]):
+    self._pending[table][doc_id] = document
+    if self.pending >= self._batch:
+      self._full.set()
+      # Yield, so a burst of writes lets the flusher catch up
+      await asyncio.sleep(0)
+
+  async def _flush_loop(self):
+    while True:
+      try:
+        await asyncio.wait_for(self._full.wait(), self._interval)
+      except asyncio.TimeoutError:
+        pass
+      self._full.clear()
+      await self.flush()
+
+  async def flush(self):
+    """ Write everything pending, on the worker thread. """
+    if not self._pending: return
+    batch, self._pending = self._pending, defaultdict(dict)
+    future = self._executor.submit(self._write, batch)
+    self._inflight = (future, batch)
+    try:
+      await asyncio.wrap_future(future)
+    except Exception as exc:
+      # Unless flush_sync already took the batch over
+      if self._inflight is None or self._inflight[0] is not future: return
+      log.error(f"Storage flush failed, will retry: {exc}", exc_info=True)
+      # Keep anything written since then on top of the failed batch
+      for table, docs in self._pending.items(): batch[table].update(docs)
+      self._pending = batch
+    finally:
+      if self._inflight is not None and self._inflight[0] is future: self._inflight = None
+
+  def flush_sync(self):
+    """
+      Write everything pending, blocking. A batch still being written on
+      the worker thread is waited for first (and retried if it failed), so
+      it can't land on top of newer writes.
+    """
+    if self._inflight is not None:
+      future, batch = self._inflight
+      self._inflight = None
+      try:
+        future.result()
+      except (Exception, CancelledError) as exc:
+        log.error(f"Storage flush failed, retrying: {exc}")
+        for table, docs in self._pending.items(): batch[table].update(docs)
+        self._pending = batch
+    batch, self._pending = self._pending, defaultdict(dict)
+    if batch: self._write(batch)
+
+  def close(self):
+    """ Stop the flusher and do a final, blocking flush. """
+    self._flusher.cancel()
+    self.flush_sync()
+    self._executor.shutdown(wait=True)
+
+  def _write(self, batch: Dict[str, Dict[int, Optional[dict]]]):
+    with self._lock:
+      for name, docs in batch.items():
+        table = self._db.table(name)
+        upserts = { doc_id: doc for doc_id, doc in docs.items() if doc is not None }
+        removes = [doc_id for doc_id, doc in docs.items() if doc is None]
+
+        if hasattr(table, "write_batch"):
+          table.write_batch(upserts, removes)
+        else:
+          # TinyDB has no public way to write with given ids, or to do
+          # several things in one go, so use what its own methods use.
+          # These are private, hence the exact pin in requirements.txt
+          def updater(rows: dict):
+            for doc_id in removes: rows.pop(doc_id, None)
+            rows.update(upserts)
+          table._update_table(updater)
+          table._next_id = None
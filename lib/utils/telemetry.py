@@ -0,0 +1,68 @@
+import statistics
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# Samples kept per series; 6 hours' worth at one every 30 seconds
+SAMPLES = 720
+
+class Series:
+  """ The last `maxlen` samples of one measurement, with when they were taken. """
+  __slots__ = ("samples",)
+
+  def __init__(self, maxlen: int = SAMPLES):
+    self.samples = deque(maxlen=maxlen) # type: deque[tuple]
+
+  def __len__(self) -> int:
+    return len(self.samples)
+
+  def add(self, value: float):
+    self.samples.append((time.time(), value))
+
+  @property
+  def last(self) -> Optional[float]:
+    return self.samples[-1][1] if self.samples else None
+
+  def summary(self) -> Dict[str, float]:
+    values = sorted(value for _, value in self.samples)
+    if not values: return { "count": 0 }
+    return {
+      "count":  len(values),
+      "last":   self.samples[-1][1],
+      "min":    values[0],
+      "median": statistics.median(values),
+      "p95":    values[int(len(values) * 0.95)],
+      "max":    values[-1],
+    }
+
+class Telemetry:
+  """
+    Named series of samples, kept in memory. Series are created on first
+    use; `timer` records how long its block took, in seconds, whether or
+    not it raised.
+  """
+  def __init__(self, maxlen: int = SAMPLES):
+    self.maxlen = maxlen
+    self.series = {} # type: Dict[str, Series]
+
+  def record(self, name: str, value: float):
+    if (series := self.series.get(name)) is None:
+      series = self.series[name] = Series(self.maxlen)
+    series.add(value)
+
+  @contextmanager
+  def timer(self, name: str):
+    start = time.perf_counter()
+    try:     yield
+    finally: self.record(name, time.perf_counter() - start)
+
+  def get(self, name: str) -> Optional[Series]:
+    return self.series.get(name)
+
+  def summary(self) -> Dict[str, Dict[str, float]]:
+    return { name: series.summary() for name, series in sorted(self.series.items()) }
+
+  def dump(self) -> Dict[str, list]:
+    """ Every sample, as [unix time, value] pairs. """
+    return { name: [list(sample) for sample in series.samples] for name, series in sorted(self.series.items()) }
@@ -1,6 +1,9 @@
 from discord import Guild
 from typing import Union
 
+# Discord's message length limit
+MESSAGE_LIMIT = 2000
+
 def fmt_quote(text: str) -> str:
   """ Prefixes every line of given `text` with a ">". """
   return "> " + text.replace("\n", "\n> ")
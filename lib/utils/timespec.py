@@ -0,0 +1,131 @@
+import calendar
+import datetime
+import re
+from typing import Callable, List, Optional, Set
+
+# Declarative schedule specs, see ./lib/schema/schedule_task.json:
+#   { "every": 2, "unit": "hours" }
+#   { "daily": "14:00" }
+#   { "weekly": "friday", "at": "14:00" }
+#   { "cron": "30 9 * * 1-5" }
+# All times are UTC.
+
+UNITS = { "seconds": 1, "minutes": 60, "hours": 3600, "days": 86400, "weeks": 604800 }
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+RLEGACY = re.compile(r"^schedule\.every\((\d*)\)\.(\w+)(?:\.at\(\"(\d{1,2}:\d{2})(?::\d{2})?\"\))?\.do$")
+
+def hhmm(text: str) -> int:
+  """ Seconds past midnight for "HH:MM". """
+  hours, minutes = map(int, text.split(":"))
+  return hours * 3600 + minutes * 60
+
+class Cron:
+  """ Minimal five-field cron expression (minute hour day month weekday). """
+  RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+  def __init__(self, expr: str):
+    fields = expr.split()
+    if len(fields) != 5: raise ValueError(f"Expected 5 cron fields, got {len(fields)}")
+    self.minutes, self.hours, self.days, self.months, self.weekdays = \
+      [self._field(field, lo, hi) for field, (lo, hi) in zip(fields, self.RANGES)]
+    # Like cron, day and weekday are OR'ed when both are restricted
+    self._any_day = fields[2] == "*"
+    self._any_weekday = fields[4] == "*"
+
+  @staticmethod
+  def _field(field: str, lo: int, hi: int) -> Set[int]:
+    values = set()
+    for part in field.split(","):
+      step = 1
+      if "/" in part:
+        part, step = part.split("/")
+        step = int(step)
+      if part == "*":    start, end = lo, hi
+      elif "-" in part:  start, end = map(int, part.split("-"))
+      else:              start = end = int(part)
+      if not lo <= start <= end <= hi or step < 1:
+        raise ValueError(f"Cron field out of range: {field}")
+      values.update(range(start, end + 1, step))
+    return values
+
+  def _day_matches(self, day: datetime.date) -> bool:
+    # cron counts weekdays from sunday
+    dom = day.day in self.days
+    dow = (day.weekday() + 1) % 7 in self.weekdays
+    if self._any_day:     return dow
+    if self._any_weekday: return dom
+    return dom or dow
+
+  def next(self, after: int) -> int:
+    """ First matching minute strictly after the epoch `after`. """
+    t = datetime.datetime.utcfromtimestamp(after).replace(second=0) + datetime.timedelta(minutes=1)
+    # Jump field by field instead of walking minutes; give up after 5 years
+    limit = t + datetime.timedelta(days=366 * 5)
+    while t < limit:
+      if t.month not in self.months:
+        t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+      elif not self._day_matches(t.date()):
+        t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+      elif t.hour not in self.hours:
+        t = t.replace(minute=0) + datetime.timedelta(hours=1)
+      elif t.minute not in self.minutes:
+        t += datetime.timedelta(minutes=1)
+      else:
+        return calendar.timegm(t.timetuple())
+    raise ValueError("Cron expression never matches")
+
+def compile_when(when: dict) -> Callable[[int], int]:
+  """
+    Compiles a schedule spec into a function that maps an epoch to the next
+    fire time strictly after it.
+  """
+  if "every" in when:
+    period = when["every"] * UNITS[when["unit"]]
+    return lambda after: after + period
+
+  if "daily" in when:
+    offset = hhmm(when["daily"])
+    def next_daily(after: int) -> int:
+      then = after - after % 86400 + offset
+      return then if then > after else then + 86400
+    return next_daily
+
+  if "weekly" in when:
+    # The epoch began on a thursday
+    offset = ((WEEKDAYS.index(when["weekly"]) - 3) % 7) * 86400 + hhmm(when["at"])
+    def next_weekly(after: int) -> int:
+      then = after - after % 604800 + offset
+      return then if then > after else then + 604800
+    return next_weekly
+
+  if "cron" in when:
+    return Cron(when["cron"]).next
+
+  raise ValueError(f"Unsupported schedule: {when}")
+
+def fmt_when(when: dict) -> str:
+  """ Human-readable schedule spec. """
+  if "every" in when:  return f"every {when['every']} {when['unit']}"
+  if "daily" in when:  return f"daily at {when['daily']}"
+  if "weekly" in when: return f"{when['weekly']}s at {when['at']}"
+  if "cron" in when:   return f"cron `{when['cron']}`"
+  return str(when)
+
+def from_directive(directive: str) -> Optional[dict]:
+  """
+    Translates an old `schedule` module directive, ie
+    `schedule.every(10).minutes.do`, into a spec. None if there's no
+    equivalent.
+  """
+  if not (match := RLEGACY.match(directive)): return None
+  every = int(match[1] or 1)
+  unit, at = match[2], match[3]
+
+  if unit.rstrip("s") + "s" in UNITS and at is None:
+    return { "every": every, "unit": unit.rstrip("s") + "s" }
+  if unit == "day" and every == 1:
+    return { "daily": (at or "00:00").zfill(5) }
+  if unit in WEEKDAYS and every == 1:
+    return { "weekly": unit, "at": (at or "00:00").zfill(5) }
+  return None
@@ -0,0 +1,26 @@
+import os
+import subprocess
+from functools import lru_cache
+from typing import Optional, Tuple
+
+# Where the commit is kept for child processes, so they needn't ask git
+ENV_COMMIT = "MYCELIA_COMMIT"
+
+@lru_cache(maxsize=None)
+def git_commit() -> Tuple[str, Optional[int]]:
+  """
+    The checked out commit's short hash and unix timestamp, from one git
+    call per process tree. ("unknown", None) outside of a git checkout.
+  """
+  if cached := os.environ.get(ENV_COMMIT):
+    commit, timestamp = cached.split(" ")
+    return commit, int(timestamp) if timestamp != "-" else None
+  try:
+    commit, timestamp = subprocess.check_output(
+      ["git", "log", "-1", "--format=%h %ct"], stderr=subprocess.DEVNULL
+    ).decode("utf-8").split()
+    timestamp = int(timestamp)
+  except (OSError, subprocess.CalledProcessError, ValueError):
+    commit, timestamp = "unknown", None
+  os.environ[ENV_COMMIT] = f"{commit} {timestamp if timestamp is not None else '-'}"
+  return commit, timestamp
@@ -25,16 +25,17 @@ logging.Logger.message = logging.Logger.msg
 # Formatters
 fmt_basic = logging.Formatter(
   fmt=FMT_BASIC, datefmt=FMT_DATETIME, style="{")
-fmt_color = colorlog.ColoredFormatter(
-  fmt=FMT_COLOR, datefmt=FMT_DATETIME, style="{",
-  log_colors={
+LOG_COLORS = {
 		"DEBUG":    "cyan",
     "MESSAGE":  "white",
 		"INFO":     "green",
 		"WARNING":  "yellow",
 		"ERROR":    "red",
 		"CRITICAL": "red,bg_white",
-	},
+	}
+fmt_color = colorlog.ColoredFormatter(
+  fmt=FMT_COLOR, datefmt=FMT_DATETIME, style="{",
+  log_colors=LOG_COLORS,
 )
 
 # Handlers
@@ -76,6 +77,25 @@ l_smalls.addHandler(hnd_file_smalls)
 l_discord.addHandler(hnd_file_smalls)
 l_wavelink.addHandler(hnd_file_smalls)
 
+def cluster_logs(cluster: int):
+  """
+    Sends Smalls' logs to ./logs/smalls.{cluster}.log instead, and tags its
+    console output, for one of several processes (see mycelia.py).
+  """
+  hnd_file_cluster = logging.handlers.RotatingFileHandler(
+    filename=f"./logs/smalls.{cluster}.log", encoding="utf-8",
+    maxBytes=MAXSIZE, backupCount=BACKUPCOUNT
+  )
+  hnd_file_cluster.setFormatter(fmt_basic)
+  for logger in (l_smalls, l_discord, l_wavelink):
+    logger.removeHandler(hnd_file_smalls)
+    logger.addHandler(hnd_file_cluster)
+
+  hnd_console.setFormatter(colorlog.ColoredFormatter(
+    fmt=FMT_COLOR.replace("{name", f"[{cluster}] {{name"), datefmt=FMT_DATETIME, style="{",
+    log_colors=LOG_COLORS,
+  ))
+
 if __name__ == "__main__":
   print("This file is not meant to be ran.")
   exit()
@@ -2,7 +2,8 @@
 
 """
 Usage:
-  mycelia.py run       (biggs | smalls)
+  mycelia.py run       (biggs | smalls) [--profile-startup]
+  mycelia.py run       smalls --shards [--profile-startup]
   mycelia.py install   (biggs | smalls | all)
   mycelia.py update    (biggs | smalls | all)
   mycelia.py uninstall (biggs | smalls | all)
@@ -12,32 +13,40 @@ Usage:
 Options:
   -h --help     Show this message.
   -v --version  Show version.
+  --shards      Spread Smalls' shards over several processes, see the
+                shard settings in settings.example.yml.
+  --profile-startup  Print how long each part of startup took.
 """
 
 # TODO figure out how to update lavalink easy
 # TODO ensure were on the right dir
 
 import os
+import time
+import asyncio
 import pathlib
-from typing import List
+import multiprocessing
+import multiprocessing.connection
+from typing import Dict, List
 from re import sub
 import subprocess
-import aiohttp
 import yaml
 from shlex import split
 from enum import Enum
 
 from docopt import docopt
 
-# Local dependencies
-from lib.biggs import Biggs
-from lib.smalls import Smalls
+# Local dependencies, the bots themselves are imported by _run
+from lib.utils.startup import profile
+from lib.utils.version import git_commit
 import logconfig
 
 DIR = pathlib.Path(__file__).parent.absolute()
-VERSION = subprocess.check_output(
-  "git rev-parse --short HEAD".split(" ")
-).decode("utf-8").strip()
+
+# Shards identify one at a time, this many seconds apart
+IDENTIFY_DELAY = 5
+# Seconds before restarting a cluster that crashed, like RestartSec below
+CLUSTER_RESTART_DELAY = 10
 
 class Bot(Enum):
   """ Enum for the available bots. """
@@ -62,25 +71,36 @@ UNIT = \
 def sh(cmds: str) -> List[subprocess.CompletedProcess]:
   return [subprocess.run(split(line)) for line in cmds.strip().split("\n")]
 
-def _run(bot: Bot):
-  # Load config
+def _config() -> dict:
   if not os.path.exists("settings.yml"):
     print("./settings.yml missing, exiting.")
     exit()
   with open("settings.yml", "r") as y:
-    config = yaml.load(y, Loader=yaml.FullLoader) # type: dict
+    return yaml.load(y, Loader=yaml.FullLoader)
+
+def _run(bot: Bot, **overrides):
+  # Load config
+  with profile.phase("config"):
+    config = _config()
 
   # Set up logging
   if bot == Bot.BIGGS: log = logconfig.l_biggs
   elif bot == Bot.SMALLS: log = logconfig.l_smalls
   else: exit() # I hate my linter
 
+  # Only the bot being run, its services import their own dependencies
+  with profile.phase(f"import lib.{bot.value}"):
+    import aiohttp
+    if bot == Bot.BIGGS: from lib.biggs import Biggs
+    elif bot == Bot.SMALLS: from lib.smalls import Smalls
+
   try:
-    log.info(f"Commit {VERSION}")
+    with profile.phase("git metadata"):
+      log.info(f"Commit {git_commit()[0]}")
 
     # Instantiate the bot
-    if bot == Bot.BIGGS: Biggs(config["biggs"])
-    elif bot == Bot.SMALLS: Smalls(config["smalls"])
+    if bot == Bot.BIGGS: Biggs({ **config["biggs"], **overrides })
+    elif bot == Bot.SMALLS: Smalls({ **config["smalls"], **overrides })
 
   except KeyboardInterrupt:
     log.info("Got KeyboardInterrupt")
@@ -89,6 +109,78 @@ def _run(bot: Bot):
   finally:
     log.info("Exiting")
 
+def _run_cluster(cluster: int, shard_ids: List[int], shard_count: int, profile_startup: bool):
+  """ Runs one cluster of Smalls' shards, in a worker process. """
+  profile.enabled = profile_startup
+  logconfig.cluster_logs(cluster)
+  _run(Bot.SMALLS, cluster=cluster, shard_ids=shard_ids, shard_count=shard_count)
+
+async def _recommended_shards(token: str) -> int:
+  from discord.http import HTTPClient
+  http = HTTPClient()
+  try:
+    await http.static_login(token, bot=True)
+    shard_count, _ = await http.get_bot_gateway()
+    return shard_count
+  finally:
+    await http.close()
+
+def _run_shards():
+  """
+    Runs Smalls' shards in `shard_clusters` worker processes (one per core
+    by default), each with its own event loop and log. Clusters that crash
+    are restarted, ones that exit cleanly (ie. setup failed) aren't.
+  """
+  config = _config()["smalls"]
+  log = logconfig.l_smalls
+
+  shard_count = config.get("shard_count") or asyncio.run(_recommended_shards(config["token"]))
+  clusters = max(1, min(config.get("shard_clusters") or os.cpu_count() or 1, shard_count))
+  layout = [
+    list(range(i * shard_count // clusters, (i + 1) * shard_count // clusters))
+    for i in range(clusters)
+  ]
+
+  # Fresh interpreters, rather than forks of this one
+  context = multiprocessing.get_context("spawn")
+  workers = {} # type: Dict[int, multiprocessing.Process]
+  def start(cluster: int):
+    workers[cluster] = context.Process(target=_run_cluster, name=f"smalls.{cluster}",
+      args=(cluster, layout[cluster], shard_count, profile.enabled))
+    workers[cluster].start()
+
+  # Resolved once here, the clusters inherit it
+  log.info(f"Commit {git_commit()[0]}")
+  try:
+    for cluster, shard_ids in enumerate(layout):
+      log.info(f"Starting cluster {cluster} with shard{'s' if len(shard_ids) != 1 else ''} {shard_ids} of {shard_count}")
+      start(cluster)
+      # Let its shards identify before the next cluster's
+      if cluster < clusters - 1: time.sleep(len(shard_ids) * IDENTIFY_DELAY)
+
+    while workers:
+      sentinels = { worker.sentinel: cluster for cluster, worker in workers.items() }
+      for sentinel in multiprocessing.connection.wait(list(sentinels)):
+        cluster = sentinels[sentinel]
+        worker = workers.pop(cluster)
+        worker.join()
+        code = worker.exitcode
+        if code == 0:
+          log.info(f"Cluster {cluster} exited")
+          continue
+        log.warning(f"Cluster {cluster} exited with code {code}, restarting it in {CLUSTER_RESTART_DELAY}s")
+        time.sleep(CLUSTER_RESTART_DELAY)
+        start(cluster)
+
+  except KeyboardInterrupt:
+    log.info("Got KeyboardInterrupt")
+  finally:
+    # Clusters get the same interrupt, give them a moment to close
+    for worker in workers.values():
+      worker.join(30)
+      if worker.is_alive(): worker.terminate()
+    log.info("Exiting")
+
 def _install(bot: Bot):
   print(f"Installing {bot.value}")
   sh("""
@@ -127,11 +219,16 @@ if __name__ == "__main__":
   os.makedirs("./data", exist_ok=True)
   os.makedirs("./unit", exist_ok=True)
 
-  args = docopt(__doc__, version=VERSION)
+  args = docopt(__doc__)
+  profile.enabled = args["--profile-startup"]
+  profile.mark("imports")
 
-  if args["run"]:
+  if args["--version"]:
+    print(git_commit()[0])
+  elif args["run"]:
     if args["biggs"]: _run(Bot.BIGGS)
-    if args["smalls"]: _run(Bot.SMALLS)
+    if args["smalls"] and args["--shards"]: _run_shards()
+    elif args["smalls"]: _run(Bot.SMALLS)
   elif args["install"]:
     if args["all"] or args["biggs"]: _install(Bot.BIGGS)
     if args["all"] or args["smalls"]: _install(Bot.SMALLS)